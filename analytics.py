@@ -0,0 +1,207 @@
+"""
+Price analytics over the PriceObservation history.
+Observations are loaded into columnar NumPy arrays sorted by (url, timestamp),
+so every statistic is computed for all products at once instead of iterating
+peewee model instances row by row.
+"""
+import numpy as np
+
+from models import PriceObservation, db
+
+DEFAULT_PERCENTILES = (10, 25, 75, 90)
+
+
+class Observations:
+    """
+    Columnar price history.
+
+    :ivar urls: Unique product URLs, indexed by `codes`.
+    :ivar stores: Store of each unique URL.
+    :ivar codes: URL index of each observation.
+    :ivar prices: Price of each observation.
+    :ivar timestamps: Unix timestamp (seconds) of each observation.
+    :ivar starts: Offset of the first observation of each URL.
+    :ivar ends: Offset after the last observation of each URL.
+    """
+    def __init__(self, urls, stores, codes, prices, timestamps):
+        order = np.lexsort((timestamps, codes))
+        self.urls = urls
+        self.stores = stores
+        self.codes = codes[order]
+        self.prices = prices[order]
+        self.timestamps = timestamps[order]
+        counts = np.bincount(self.codes, minlength=len(urls))
+        self.ends = np.cumsum(counts)
+        self.starts = self.ends - counts
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def counts(self):
+        return self.ends - self.starts
+
+
+def load_observations(store=None, query=None, since=None):
+    """
+    Load price observations into NumPy arrays.
+
+    :param store: Only load observations of this store.
+    :type store: str, None
+    :param query: Only load observations of this search query.
+    :type query: str, None
+    :param since: Only load observations newer than this date.
+    :type since: datetime.datetime, None
+    :return: The observations, grouped by URL.
+    :rtype: Observations
+    """
+    select = PriceObservation.select(
+        PriceObservation.url, PriceObservation.store, PriceObservation.price, PriceObservation.timestamp
+    )
+    if store:
+        select = select.where(PriceObservation.store == store)
+    if query:
+        select = select.where(PriceObservation.query == query)
+    if since:
+        select = select.where(PriceObservation.timestamp >= since)
+
+    # Raw cursor rows skip model instantiation and timestamp conversion.
+    sql, params = select.sql()
+    rows = db.execute_sql(sql, params).fetchall()
+    if not rows:
+        empty = np.array([], dtype=np.int64)
+        return Observations(np.array([], dtype=object), np.array([], dtype=object), empty, empty.astype(np.float64), empty)
+
+    urls, stores, prices, timestamps = zip(*rows)
+    urls, first, codes = np.unique(np.array(urls, dtype=object), return_index=True, return_inverse=True)
+    timestamps = np.array(timestamps, dtype='datetime64[us]').astype('datetime64[s]').astype(np.int64)
+    return Observations(
+        urls,
+        np.array(stores, dtype=object)[first],
+        codes.astype(np.int64),
+        np.array(prices, dtype=np.float64),
+        timestamps,
+    )
+
+
+def _group_percentile(sorted_prices, starts, counts, percentile):
+    """
+    Linear-interpolated percentile of every group of an array sorted by (group, price).
+    """
+    position = (counts - 1) * (percentile / 100.0)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.minimum(lower + 1, counts - 1)
+    weight = position - lower
+    return sorted_prices[starts + lower] * (1 - weight) + sorted_prices[starts + upper] * weight
+
+
+def price_stats(observations, percentiles=DEFAULT_PERCENTILES):
+    """
+    Compute min, max, mean, median and percentiles of the price of every URL.
+
+    :param observations: Observations returned by load_observations.
+    :type observations: Observations
+    :param percentiles: Percentiles to compute, from 0 to 100.
+    :type percentiles: tuple
+    :return: Dictionary of column name to NumPy array, one row per URL.
+    :rtype: dict
+    """
+    counts = observations.counts
+    present = counts > 0
+    starts = observations.starts[present]
+    counts = counts[present]
+    sorted_prices = observations.prices[np.lexsort((observations.prices, observations.codes))]
+
+    stats = {
+        'url': observations.urls[present],
+        'store': observations.stores[present],
+        'count': counts,
+        'min': np.minimum.reduceat(sorted_prices, starts) if len(starts) else sorted_prices[:0],
+        'max': np.maximum.reduceat(sorted_prices, starts) if len(starts) else sorted_prices[:0],
+        'mean': np.add.reduceat(sorted_prices, starts) / counts if len(starts) else sorted_prices[:0],
+        'median': _group_percentile(sorted_prices, starts, counts, 50),
+        'last': observations.prices[observations.ends[present] - 1],
+    }
+    for percentile in percentiles:
+        stats[f'p{percentile}'] = _group_percentile(sorted_prices, starts, counts, percentile)
+    return stats
+
+
+def rolling_mean(observations, window):
+    """
+    Rolling average of the last `window` observations, computed per URL.
+
+    :param observations: Observations returned by load_observations.
+    :type observations: Observations
+    :param window: Number of observations in the window.
+    :type window: int
+    :return: Rolling average aligned with observations.prices. The first
+             observations of each URL average over the ones available.
+    :rtype: numpy.ndarray
+    """
+    cumulative = np.concatenate(([0.0], np.cumsum(observations.prices)))
+    index = np.arange(len(observations.prices))
+    group_start = observations.starts[observations.codes]
+    window_start = np.maximum(index + 1 - window, group_start)
+    return (cumulative[index + 1] - cumulative[window_start]) / (index + 1 - window_start)
+
+
+def detect_drops(observations, threshold=0.1, window=5, new_only=False):
+    """
+    Find the URLs whose latest price is below the baseline by at least `threshold`.
+    The baseline is the mean of the previous `window` observations of that URL.
+
+    :param observations: Observations returned by load_observations.
+    :type observations: Observations
+    :param threshold: Minimum relative drop, 0.1 means 10% cheaper.
+    :type threshold: float
+    :param window: Number of previous observations used as baseline.
+    :type window: int
+    :param new_only: Only report drops that happened at the latest observation
+                     (latest price below the previous one). A price that stays
+                     down is then reported once, not on every scrape while the
+                     baseline catches up.
+    :type new_only: bool
+    :return: One dictionary per drop, biggest drop first.
+    :rtype: list
+    :raises ValueError: If window is lower than 1.
+    """
+    if window < 1:
+        raise ValueError("window must be at least 1")
+    counts = observations.counts
+    candidates = np.flatnonzero(counts > 1)
+    if not len(candidates):
+        return []
+
+    cumulative = np.concatenate(([0.0], np.cumsum(observations.prices)))
+    last = observations.ends[candidates] - 1
+    baseline_start = np.maximum(last - window, observations.starts[candidates])
+    baseline = (cumulative[last] - cumulative[baseline_start]) / (last - baseline_start)
+    latest = observations.prices[last]
+    drop = np.divide(baseline - latest, baseline, out=np.zeros_like(baseline), where=baseline > 0)
+
+    hit = drop >= threshold
+    if new_only:
+        hit &= latest < observations.prices[last - 1]
+    hits = np.flatnonzero(hit)
+    hits = hits[np.argsort(-drop[hits])]
+    return [
+        {
+            'url': observations.urls[candidates[hit]],
+            'store': observations.stores[candidates[hit]],
+            'baseline': round(float(baseline[hit]), 2),
+            'price': float(latest[hit]),
+            'drop': round(float(drop[hit]), 4),
+            'timestamp': str(np.datetime64(int(observations.timestamps[last[hit]]), 's')),
+        }
+        for hit in hits
+    ]
+
+
+def stats_to_dicts(stats):
+    """
+    Convert the columns returned by price_stats into JSON serializable rows.
+    """
+    columns = list(stats)
+    values = [stats[column].tolist() for column in columns]
+    return [dict(zip(columns, row)) for row in zip(*values)]
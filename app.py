@@ -1,36 +1,271 @@
-from flask import Flask, request, jsonify
-from scrapers.fravega_scraper import FravegaScraper
-from scrapers.perozzi_scraper import PerozziScraper
+import logging
+import queue
+import threading
+
+from flask import Flask, Response, request, jsonify
+from scrapers.base_scraper import configure_logging
+from scrapers.registry import create_scraper
+from scrapers.pipeline import run_pipeline, run_profiled
+from models import initialize_database
+from persistence import get_changes
+import profiling
+from records import ALL_FIELDS, FIELDS
+from responses import ResultSets, decode_cursor, dumps, encode_cursor, json_response
 """
 excluding GarbarinoScraper, because need Playwright, and need to fix TimeoutError, 
 but with the rest of the scraper like FravegaScraper, and PerozziScraper work great with requests
 """
+STORES = ['Fravega', 'Perozzi']
+MAX_BATCH_QUERIES = 200
+MAX_PAGE_SIZE = 1000
+MAX_CHANGES = 5000
+
 app = Flask(__name__)
+configure_logging()
+initialize_database()
+
+# NumPy backed helpers are imported on first use, workers that only
+# serve /scrape never load them.
+_matcher = None
+_matcher_lock = threading.Lock()
+
+# Results paged through /scrape cursors, so the next pages are not scraped again.
+result_sets = ResultSets()
+
+
+def get_matcher():
+    global _matcher
+    if _matcher is None:
+        with _matcher_lock:
+            if _matcher is None:
+                from matching import ProductMatcher
+                _matcher = ProductMatcher()
+    return _matcher
+
+
+def normalize_query(query):
+    return ' '.join(query.lower().split())
+
+
+def is_positive_int(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value > 0
+
+
+def run_scrapers(query, send_notifications=False, max_results=None, profile=False):
+    scrapers = [create_scraper(store, query, max_results=max_results) for store in STORES]
+    if profile or profiling.ENABLED:
+        with profiling.profile_run(query, STORES, source='/scrape') as profiler:
+            return run_profiled(scrapers, profiler, send_notifications=send_notifications)
+    return run_pipeline(scrapers, send_notifications=send_notifications)
+
 
 @app.route('/scrape', methods=['POST'])
 def scrape():
+    """
+    Optional pagination: "limit" products per response across all stores, and
+    the "cursor" returned as next_cursor for the following page. "fields"
+    selects the product fields to return (name, price, url, image_url, store).
+    The first page scrapes, the result is kept for RESULT_TTL seconds (see
+    responses.py) and the next pages are read from it; an expired cursor gets
+    a 410, start again without cursor.
+    The "X-Profile: 1" header profiles the run when SCRAPER_PROFILE_HEADER is
+    set, see profiling.py.
+    """
     query = request.json.get('query', '')
     send_notifications = request.json.get('send_notifications', False)
-    
+    max_results = request.json.get('max_results')
+    fields = request.json.get('fields') or FIELDS
+    limit = request.json.get('limit')
+    cursor = request.json.get('cursor')
+
+    if not query and cursor is None:
+        return jsonify({"error": "Query is missing"}), 400
+    if max_results is not None and not is_positive_int(max_results):
+        return jsonify({"error": "max_results must be a positive integer"}), 400
+    if not isinstance(fields, (list, tuple)) or not all(isinstance(field, str) for field in fields) or not set(fields) <= set(ALL_FIELDS):
+        return jsonify({"error": f"Fields must be a list of {', '.join(ALL_FIELDS)}"}), 400
+    fields = tuple(fields)
+    if limit is not None and not is_positive_int(limit):
+        return jsonify({"error": "Limit must be a positive integer"}), 400
+
+    if cursor is not None:
+        try:
+            result_id, offset = decode_cursor(cursor)
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        batches = result_sets.get(result_id)
+        if batches is None:
+            return jsonify({"error": "Cursor expired, request the first page again"}), 410
+    else:
+        profile = profiling.header_requested(request.headers)
+        scrapers = run_scrapers(query, send_notifications=send_notifications, max_results=max_results, profile=profile)
+        if limit is None:
+            all_results = {scraper.store: scraper.products.to_dicts(fields) for scraper in scrapers}
+            return json_response(all_results)
+        batches = [scraper.products for scraper in scrapers]
+        # Same products, same cursor: the page body and its ETag are stable.
+        result_id = result_sets.put(batches, content=b''.join(products.digest() for products in batches))
+        offset = 0
+
+    # Products are paged as one list, store after store.
+    limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+    results = {}
+    position = 0
+    taken = 0
+    for products in batches:
+        count = len(products)
+        start = min(max(offset - position, 0), count)
+        stop = min(start + limit - taken, count)
+        results[products.store] = products.to_dicts(fields, start=start, stop=stop)
+        taken += stop - start
+        position += count
+
+    next_offset = offset + taken
+    return json_response({
+        'results': results,
+        'total': position,
+        'next_cursor': encode_cursor(result_id, next_offset) if next_offset < position else None,
+    })
+
+@app.route('/scrape/batch', methods=['POST'])
+def scrape_batch():
+    """
+    Scrape many queries at once: {"queries": [...], "send_notifications": false, "max_results": null}
+    Queries are normalized and deduplicated, every store x query runs through one
+    pipeline and products found by several queries are saved once. The response
+    is streamed as NDJSON, one line per store and query as soon as it finishes.
+    """
+    queries = request.json.get('queries', [])
+    send_notifications = request.json.get('send_notifications', False)
+    max_results = request.json.get('max_results')
+
+    if not isinstance(queries, list):
+        return jsonify({"error": "Queries must be a list"}), 400
+    if max_results is not None and not is_positive_int(max_results):
+        return jsonify({"error": "max_results must be a positive integer"}), 400
+    queries = list(dict.fromkeys(normalize_query(query) for query in queries if isinstance(query, str)))
+    queries = [query for query in queries if query]
+    if not queries:
+        return jsonify({"error": "Queries are missing"}), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        return jsonify({"error": f"At most {MAX_BATCH_QUERIES} queries per batch"}), 400
+
+    scrapers = []
+    query_of = {}
+    for query in queries:
+        for store in STORES:
+            scraper = create_scraper(store, query, max_results=max_results)
+            query_of[id(scraper)] = query
+            scrapers.append(scraper)
+
+    finished = queue.Queue()
+
+    def run():
+        try:
+            run_pipeline(
+                scrapers,
+                send_notifications=send_notifications,
+                dedupe=True,
+                on_done=lambda scraper, error: finished.put((scraper, error)),
+            )
+        except Exception as e:
+            logging.error("Error on batch scrape: %s", e)
+        finally:
+            finished.put(None)
+
+    threading.Thread(target=run, name='scrape-batch', daemon=True).start()
+
+    def stream():
+        while True:
+            item = finished.get()
+            if item is None:
+                return
+            scraper, error = item
+            line = {'query': query_of[id(scraper)], 'store': scraper.store}
+            if error is None:
+                line['products'] = scraper.products.to_dicts()
+            else:
+                line['error'] = str(error)
+            yield dumps(line) + b'\n'
+
+    return Response(stream(), mimetype='application/x-ndjson')
+
+@app.route('/compare', methods=['POST'])
+def compare():
+    """
+    Same input as /scrape, but the offers are grouped into canonical products
+    across stores, cheapest offer first. The matcher is kept between requests,
+    so each call only adds its new offers to the index.
+    """
+    query = request.json.get('query', '')
+    send_notifications = request.json.get('send_notifications', False)
+    max_results = request.json.get('max_results')
+    min_stores = request.json.get('min_stores', 1)
 
     if not query:
         return jsonify({"error": "Query is missing"}), 400
+    if max_results is not None and not is_positive_int(max_results):
+        return jsonify({"error": "max_results must be a positive integer"}), 400
+    if not is_positive_int(min_stores):
+        return jsonify({"error": "min_stores must be a positive integer"}), 400
+
+    matcher = get_matcher()
+    touched = []
+    for scraper in run_scrapers(query, send_notifications=send_notifications, max_results=max_results):
+        touched += matcher.add_offers(scraper.store, scraper.products)
+
+    products = {}
+    for product in touched:
+        products[product.id] = product
+    results = [
+        product.to_dict() for product in products.values()
+        if len({offer.store for offer in product.offers}) >= min_stores
+    ]
+    results.sort(key=lambda product: product['price_min'])
+
+    return json_response(results)
+
+@app.route('/changes', methods=['GET'])
+def changes():
+    """
+    Products added, repriced, updated or removed since a cursor: GET /changes?since=<cursor>&limit=500
+    Start with since=0 and pass the returned cursor on the next call.
+    """
+    since = request.args.get('since', 0, type=int)
+    limit = max(1, min(request.args.get('limit', 500, type=int), MAX_CHANGES))
+    items, cursor = get_changes(since=since, limit=limit)
+    return json_response({'changes': items, 'cursor': cursor, 'has_more': len(items) == limit})
+
+@app.route('/analytics/prices', methods=['GET'])
+def price_statistics():
+    """
+    Price statistics per product URL: count, min, max, mean, median, last and percentiles.
+    Optional filters: store, query.
+    """
+    import analytics
 
-    fravega_scraper = FravegaScraper(query)
-    #garbarino_scraper = GarbarinoScraper(query)
-    perozzi_scraper = PerozziScraper(query)
+    observations = analytics.load_observations(store=request.args.get('store'), query=request.args.get('query'))
+    stats = analytics.price_stats(observations)
+    return jsonify(analytics.stats_to_dicts(stats)), 200
 
-    fravega_scraper.run(send_notifications=send_notifications)
-    #garbarino_scraper.run(send_notifications=send_notifications)
-    perozzi_scraper.run(send_notifications=send_notifications)
+@app.route('/analytics/drops', methods=['GET'])
+def price_drops():
+    """
+    Products whose latest price is below the average of their previous observations.
+    Optional filters: store, query, threshold (default 0.1) and window (default 5).
+    """
+    import analytics
 
-    all_results = {
-        'Fravega': fravega_scraper.products,
-        #'Garbarino': garbarino_scraper.products,
-        'Perozzi': perozzi_scraper.products
-    }
+    threshold = request.args.get('threshold', 0.1, type=float)
+    window = request.args.get('window', 5, type=int)
+    if not 0 < threshold <= 1:
+        return jsonify({"error": "Threshold must be greater than 0 and at most 1"}), 400
+    if window < 1:
+        return jsonify({"error": "Window must be a positive integer"}), 400
 
-    return jsonify(all_results), 200
+    observations = analytics.load_observations(store=request.args.get('store'), query=request.args.get('query'))
+    drops = analytics.detect_drops(observations, threshold=threshold, window=window)
+    return jsonify(drops), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
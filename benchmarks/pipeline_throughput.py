@@ -0,0 +1,56 @@
+"""
+Throughput of the fetch -> parse -> save pipeline on a multi-query workload,
+against running the scrapers one after the other. Fetching is simulated with
+a fixed delay and a synthetic Perozzi results page, nothing is saved.
+
+    python -m benchmarks.pipeline_throughput [queries] [products_per_page]
+"""
+import sys
+import time
+
+from scrapers import pipeline
+from scrapers.perozzi_scraper import PerozziScraper
+
+FETCH_DELAY = 0.2
+
+
+def fake_page(products):
+    return ''.join(
+        f'<div class="js-product-miniature-wrapper"><h2 class="h3 product-title">'
+        f'<a href="https://www.perozzi.com.ar/celulares/{index}.html">Celular Samsung Galaxy A{index}</a></h2>'
+        f'<span class="product-price">$ 1.234,{index % 100:02d}</span>'
+        f'<img class="img-fluid" data-src="https://www.perozzi.com.ar/img/{index}.jpg"></div>'
+        for index in range(products)
+    )
+
+
+class BenchScraper(PerozziScraper):
+    page = ''
+
+    def page_url(self, page):
+        return None
+
+    def fetch_results(self):
+        time.sleep(FETCH_DELAY)
+        return self.page
+
+
+if __name__ == '__main__':
+    queries = int(sys.argv[1]) if len(sys.argv) > 1 else 16
+    products = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    BenchScraper.page = fake_page(products)
+    pipeline.get_parse_pool().submit(int).result()
+
+    start = time.perf_counter()
+    for index in range(queries):
+        scraper = BenchScraper(f'query {index}')
+        scraper.parse(scraper.fetch_results())
+    sequential = time.perf_counter() - start
+
+    start = time.perf_counter()
+    pipeline.run_pipeline([BenchScraper(f'query {index}') for index in range(queries)], save=False)
+    pipelined = time.perf_counter() - start
+
+    print(f'{queries} queries x {products} products, {pipeline.PARSE_WORKERS} parse workers')
+    print(f'sequential: {sequential:6.2f} s  {queries / sequential:6.1f} queries/s')
+    print(f' pipeline : {pipelined:6.2f} s  {queries / pipelined:6.1f} queries/s')
@@ -0,0 +1,59 @@
+"""
+Memory benchmark of a large result page: list of dicts vs ProductRecord vs ProductBatch.
+
+    python -m benchmarks.records_memory [count]
+"""
+import gc
+import sys
+import time
+import tracemalloc
+
+from records import ProductBatch, ProductRecord
+
+
+def fake_products(count):
+    for index in range(count):
+        yield (
+            f'Celular Samsung Galaxy A{index % 90} 128GB Negro {index}',
+            float(100000 + index),
+            f'https://www.perozzi.com.ar/celulares/{index}-celular-samsung-galaxy-a{index % 90}.html',
+            f'https://www.perozzi.com.ar/{index}-home_default/celular-samsung-galaxy.jpg',
+        )
+
+
+def build_dicts(count):
+    products = []
+    for name, price, url, image_url in fake_products(count):
+        products.append({'name': name, 'price': price, 'url': url, 'image_url': image_url})
+    return products
+
+
+def build_records(count):
+    return [ProductRecord(name, price, url, image_url, 'Perozzi') for name, price, url, image_url in fake_products(count)]
+
+
+def build_batch(count):
+    batch = ProductBatch('Perozzi')
+    for name, price, url, image_url in fake_products(count):
+        batch.append(name, price, url, image_url)
+    return batch
+
+
+def measure(builder, count):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = builder(count)
+    elapsed = time.perf_counter() - start
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current, peak, elapsed
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print(f'{count} products')
+    for label, builder in (('dicts', build_dicts), ('records', build_records), ('batch', build_batch)):
+        current, peak, elapsed = measure(builder, count)
+        print(f'{label:>8}: {current / count:7.1f} bytes/product, peak {peak / 2**20:6.1f} MiB, {elapsed * 1000:6.1f} ms')
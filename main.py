@@ -1,4 +1,5 @@
-from scraper import FravegaScraper, GarbarinoScraper, PerozziScraper
+from scrapers.base_scraper import configure_logging
+from scrapers.registry import create_scraper
 from models import initialize_database
 
 #SEARCH_QUERY = "celular+samsung+a23"
@@ -6,14 +7,14 @@ SEARCH_QUERY = "celular%20samsung%20galaxy%20a23"
 
 
 if __name__ == "__main__":
+    configure_logging()
     initialize_database()
 
-    fravega_scraper = FravegaScraper(SEARCH_QUERY)
+    fravega_scraper = create_scraper('Fravega', SEARCH_QUERY)
     fravega_scraper.run()
 
-    garbarino_scraper = GarbarinoScraper(SEARCH_QUERY)
+    garbarino_scraper = create_scraper('Garbarino', SEARCH_QUERY)
     garbarino_scraper.run()
 
-    perozzi_scraper = PerozziScraper("celular+samsung+a23")
+    perozzi_scraper = create_scraper('Perozzi', "celular+samsung+a23")
     perozzi_scraper.run()
-    
\ No newline at end of file
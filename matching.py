@@ -0,0 +1,258 @@
+"""
+Cross-store product matching.
+Groups the offers returned by every scraper into canonical products, so the
+same phone sold by Fravega and Perozzi ends up under one entry with the
+cheapest offer highlighted.
+"""
+import re
+import threading
+import unicodedata
+
+from records import ALL_FIELDS
+
+BRANDS = {
+    'samsung', 'motorola', 'xiaomi', 'apple', 'nokia', 'lg', 'tcl',
+    'alcatel', 'huawei', 'oppo', 'realme', 'zte', 'philco', 'noblex', 'sony',
+    'bgh', 'hisense', 'lenovo', 'asus', 'hp', 'acer', 'dell', 'philips',
+}
+BRAND_ALIASES = {'iphone': 'apple', 'moto': 'motorola', 'redmi': 'xiaomi'}
+
+COLORS = {
+    'negro', 'blanco', 'azul', 'rojo', 'verde', 'gris', 'plata', 'dorado',
+    'violeta', 'rosa', 'celeste', 'amarillo', 'grafito', 'lavanda', 'crema',
+    'black', 'white', 'blue', 'red', 'green', 'gray', 'grey', 'silver', 'gold',
+    'purple', 'pink', 'graphite', 'lavender', 'cream', 'awesome', 'mint',
+}
+
+STOPWORDS = {
+    'celular', 'smartphone', 'telefono', 'movil', 'libre', 'liberado', 'de',
+    'del', 'con', 'y', 'en', 'el', 'la', 'para', 'sim', 'dual', 'ds', 'nuevo',
+    'equipo', 'pantalla', 'ram', 'memoria', 'interna', 'camara', 'color', 'moto',
+}
+
+# Tokens that turn a model into a different product ("s23" vs "s23 ultra").
+VARIANTS = {'pro', 'max', 'ultra', 'plus', 'lite', 'mini', 'fe', 'neo', 'prime', 'power', 'play'}
+
+STORAGE_RE = re.compile(r'(\d+)\s*(gb|tb)\b')
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+
+MATCH_THRESHOLD = 0.75
+
+
+def normalize_name(name: str) -> dict:
+    """
+    Normalize a product name into the tokens used for matching.
+
+    :param name: Product name as published by the store.
+    :type name: str
+    :return: Dictionary with 'brand', 'storage' (in GB), 'color' and 'tokens' (model tokens).
+    :rtype: dict
+    """
+    text = name.lower()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(char for char in text if not unicodedata.combining(char))
+
+    storage = None
+    for amount, unit in STORAGE_RE.findall(text):
+        size = int(amount) * (1024 if unit == 'tb' else 1)
+        if storage is None or size > storage:
+            storage = size
+    text = STORAGE_RE.sub(' ', text)
+
+    brand = None
+    color = None
+    tokens = []
+    for token in TOKEN_RE.findall(text):
+        if token in BRANDS:
+            brand = brand or token
+            continue
+        if token in BRAND_ALIASES:
+            brand = brand or BRAND_ALIASES[token]
+        if token in COLORS:
+            color = color or token
+            continue
+        if token in STOPWORDS or token in tokens:
+            continue
+        tokens.append(token)
+
+    return {'brand': brand, 'storage': storage, 'color': color, 'tokens': tokens}
+
+
+def _signature(tokens) -> frozenset:
+    """
+    Tokens that must be identical for two offers to be the same product:
+    model numbers (anything containing a digit) and variant words.
+    """
+    return frozenset(token for token in tokens if token in VARIANTS or not token.isalpha())
+
+
+class CanonicalProduct:
+    """
+    A group of offers from one or more stores for the same product.
+    """
+    def __init__(self, product_id, brand, storage, tokens):
+        self.id = product_id
+        self.brand = brand
+        self.storage = storage
+        self.tokens = tokens
+        self.offers = []
+
+    @property
+    def name(self):
+        parts = [self.brand or ''] + self.tokens
+        if self.storage:
+            parts.append(f'{self.storage}gb')
+        return ' '.join(part for part in parts if part)
+
+    @property
+    def cheapest(self):
+        return min(self.offers, key=lambda offer: offer.price) if self.offers else None
+
+    def to_dict(self):
+        offers = [offer.to_dict(ALL_FIELDS) for offer in sorted(self.offers, key=lambda offer: offer.price)]
+        return {
+            'id': self.id,
+            'name': self.name,
+            'brand': self.brand,
+            'storage_gb': self.storage,
+            'stores': sorted({offer['store'] for offer in offers}),
+            'price_min': offers[0]['price'] if offers else None,
+            'price_max': offers[-1]['price'] if offers else None,
+            'cheapest': offers[0] if offers else None,
+            'offers': offers,
+        }
+
+
+class ProductMatcher:
+    """
+    Incremental matching engine.
+
+    Offers are first looked up by their exact normalized key; offers that miss
+    are scored against an inverted token index (token -> canonical product ids),
+    so each lookup only touches the products sharing a token instead of every
+    product with the same model number seen so far. Posting lists are a handful
+    of ids, plain dict counting beats any per-offer NumPy call on them.
+    """
+    def __init__(self, threshold=MATCH_THRESHOLD):
+        self.threshold = threshold
+        self.products = []
+        self._lock = threading.Lock()
+        self._by_key = {}
+        self._by_url = {}
+        # Postings are partitioned by signature: offers with different model
+        # numbers or variants can never match, so they never share a list.
+        self._postings = {}
+        self._signatures = {}
+        # Per-product columns used for scoring and filtering.
+        self._sizes = []
+        self._brands = []
+        self._storages = []
+
+    def __len__(self):
+        return len(self.products)
+
+    def add_offers(self, store, products):
+        """
+        Match a batch of offers from one store.
+
+        :param store: Store name, e.g. 'Fravega'.
+        :type store: str
+        :param products: Products as produced by the scrapers.
+        :type products: records.ProductBatch
+        :return: The canonical products touched by this batch.
+        :rtype: list
+        """
+        touched = {}
+        with self._lock:
+            for product in products:
+                canonical = self._add_offer(store, product)
+                touched[canonical.id] = canonical
+        return list(touched.values())
+
+    def add_offer(self, store, product):
+        """
+        Match a single offer, returning its canonical product.
+        """
+        with self._lock:
+            return self._add_offer(store, product)
+
+    def groups(self, min_stores=1):
+        """
+        Return the canonical products offered by at least `min_stores` stores.
+        """
+        with self._lock:
+            return [
+                product for product in self.products
+                if len({offer.store for offer in product.offers}) >= min_stores
+            ]
+
+    def _add_offer(self, store, offer):
+        offer.store = store
+        url = offer.url
+
+        previous = self._by_url.get(url)
+        if previous is not None:
+            canonical = self.products[previous]
+            canonical.offers = [item for item in canonical.offers if item.url != url]
+            canonical.offers.append(offer)
+            return canonical
+
+        normalized = normalize_name(offer.name)
+        key = (normalized['brand'], normalized['storage'], frozenset(normalized['tokens']))
+        product_id = self._by_key.get(key)
+        if product_id is None:
+            signature = _signature(normalized['tokens'])
+            product_id = self._best_match(normalized, signature)
+            if product_id is None:
+                product_id = self._new_product(normalized, signature)
+        self._by_key.setdefault(key, product_id)
+
+        canonical = self.products[product_id]
+        canonical.offers.append(offer)
+        self._by_url[url] = product_id
+        return canonical
+
+    def _best_match(self, normalized, signature):
+        tokens = normalized['tokens']
+        signature = self._signatures.get(signature)
+        if signature is None:
+            return None
+
+        overlap = {}
+        postings = self._postings
+        for token in tokens:
+            for product_id in postings.get((signature, token), ()):
+                overlap[product_id] = overlap.get(product_id, 0) + 1
+        if not overlap:
+            return None
+
+        brand = normalized['brand']
+        storage = normalized['storage']
+        sizes, brands, storages = self._sizes, self._brands, self._storages
+        size = len(tokens)
+        best = None
+        best_score = self.threshold
+        for product_id, count in overlap.items():
+            score = 2.0 * count / (size + sizes[product_id])
+            # Ties go to the oldest product.
+            if score < best_score or (score == best_score and best is not None and product_id > best):
+                continue
+            if brand and brands[product_id] and brands[product_id] != brand:
+                continue
+            if storage and storages[product_id] and storages[product_id] != storage:
+                continue
+            best, best_score = product_id, score
+        return best
+
+    def _new_product(self, normalized, signature):
+        product_id = len(self.products)
+        tokens = normalized['tokens']
+        self.products.append(CanonicalProduct(product_id, normalized['brand'], normalized['storage'], tokens))
+        self._sizes.append(len(tokens))
+        self._brands.append(normalized['brand'])
+        self._storages.append(normalized['storage'])
+        signature = self._signatures.setdefault(signature, len(self._signatures))
+        for token in tokens:
+            self._postings.setdefault((signature, token), []).append(product_id)
+        return product_id
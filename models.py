@@ -1,29 +1,133 @@
 import datetime
-from peewee import Model, SqliteDatabase, CharField, FloatField, DateTimeField
-import os
+from urllib.parse import unquote_plus
 
-db = SqliteDatabase('products.db')
+from peewee import chunked, Model, SqliteDatabase, BooleanField, CharField, FloatField, DateTimeField, IntegerField
+from playhouse.migrate import SqliteMigrator, migrate
+
+# WAL lets readers (one connection per thread, peewee's default) keep working
+# while the write-behind writer (persistence.py) commits. synchronous=normal
+# is durable in WAL mode except on power loss.
+db = SqliteDatabase('products.db', timeout=10, pragmas={
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'cache_size': -64 * 1024,
+    'temp_store': 'memory',
+    'mmap_size': 256 * 1024 * 1024,
+})
+
+
+CHANGE_ADDED = 'added'
+CHANGE_REPRICED = 'repriced'
+CHANGE_UPDATED = 'updated'
+CHANGE_REMOVED = 'removed'
 
 
 class Product(Model):
+    """
+    Latest state of every product. Each write that changes a product gives it
+    the next value of `seq`, which is what the /changes feed pages through;
+    `content_hash` lets the save path skip rows that did not change.
+    """
     name = CharField()
     price = FloatField()
-    url = CharField()
+    url = CharField(index=True)
     image_url = CharField()
     timestamp = DateTimeField(default=datetime.datetime.now)
+    store = CharField(null=True)
+    query = CharField(null=True)
+    content_hash = CharField(default='')
+    seq = IntegerField(default=0, index=True)
+    change = CharField(default=CHANGE_ADDED)
+    removed = BooleanField(default=False)
 
     class Meta:
         database = db
 
 
+class PriceObservation(Model):
+    """
+    Append-only price history, one row per product seen on each scrape.
+    Product keeps only the latest price, this table is what analytics reads.
+    """
+    store = CharField(index=True)
+    query = CharField(index=True)
+    url = CharField(index=True)
+    price = FloatField()
+    timestamp = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        database = db
+
+
+class ProductQuery(Model):
+    """
+    Which queries list each product: one row per URL in the latest result of a
+    store and query. A product is marked removed only once no query lists it,
+    so products found by overlapping queries do not flip between removed and
+    added. `query` is normalized with query_key().
+    """
+    store = CharField()
+    query = CharField()
+    url = CharField(index=True)
+
+    class Meta:
+        database = db
+        indexes = (
+            (('store', 'query', 'url'), True),
+        )
+
+
+def query_key(query):
+    """
+    Normalize a search query, so 'Samsung%20A54' and 'samsung  a54' are the same search.
+
+    :param query: The search query, as formatted by the scraper.
+    :type query: str
+    :rtype: str
+    """
+    return ' '.join(unquote_plus(query or '').lower().split())
+
+
 def create_tables():
     with db:
-        db.create_tables([Product])
+        db.create_tables([Product, PriceObservation, ProductQuery])
+
+
+def backfill_product_queries():
+    """
+    Link the products that are not removed to the query that last saved them,
+    for databases created before ProductQuery existed.
+    """
+    rows = Product.select(Product.store, Product.query, Product.url).where(Product.removed == False).tuples()
+    links = {(store or '', query_key(query), url) for store, query, url in rows}
+    with db.atomic():
+        for batch in chunked([{'store': store, 'query': query, 'url': url} for store, query, url in links], 100):
+            ProductQuery.insert_many(batch).on_conflict_ignore().execute()
+
+
+def migrate_database():
+    """
+    Add the Product columns introduced after the table was first created.
+    """
+    existing = {column.name for column in db.get_columns(Product._meta.table_name)}
+    missing = [field for field in Product._meta.sorted_fields if field.column_name not in existing]
+    if not missing:
+        return
+    migrator = SqliteMigrator(db)
+    migrate(*[migrator.add_column(Product._meta.table_name, field.column_name, field) for field in missing])
 
 
 def initialize_database():
-    if not os.path.exists('products.db'):
-        create_tables()
+    upgrade = db.table_exists(Product._meta.table_name)
+    backfill = upgrade and not db.table_exists(ProductQuery._meta.table_name)
+    # Columns must exist before create_tables() adds the indexes on them.
+    if upgrade:
+        migrate_database()
+    # Tables and indexes are created with IF NOT EXISTS, so this also upgrades
+    # databases created by older versions.
+    create_tables()
+    if backfill:
+        backfill_product_queries()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,309 @@
+"""
+Write-behind persistence.
+Scrapers hand their product batches to a single writer thread through a
+bounded queue and return right away; the writer saves each batch in one
+transaction. Only this thread writes to SQLite, so concurrent /scrape calls
+never fight for the write lock, and readers keep their own per-thread
+connection thanks to WAL mode (see models.py).
+"""
+import atexit
+import datetime
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from peewee import OperationalError, chunked, fn
+from tenacity import before_sleep_log, retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from models import CHANGE_ADDED, CHANGE_REMOVED, CHANGE_REPRICED, CHANGE_UPDATED, Product, PriceObservation, ProductQuery, db, query_key
+
+QUEUE_SIZE = 64
+BATCH_SIZE = 100
+# A locked database (busy timeout hit while another process writes) is retried
+# with backoff, 0.5 + 1 + 2 + 4 seconds, before the batch is given up.
+WRITE_ATTEMPTS = 5
+
+CHANGE_FIELDS = [
+    Product.name, Product.price, Product.image_url, Product.timestamp, Product.store, Product.query,
+    Product.content_hash, Product.seq, Product.change, Product.removed,
+]
+REMOVE_FIELDS = [Product.timestamp, Product.seq, Product.change, Product.removed]
+
+_STOP = object()
+
+
+def save_products(store, query, products, complete=True, listed=None):
+    """
+    Save a batch of products and their price observations in one transaction.
+
+    Rows whose content hash did not change are not written at all. Every
+    changed row gets the next value of Product.seq for the /changes feed.
+    ProductQuery records which queries list each URL; a complete result unlinks
+    the URLs it no longer lists, and those no other query lists are marked removed.
+
+    :param store: Store name, e.g. 'Fravega'.
+    :type store: str
+    :param query: The search query.
+    :type query: str
+    :param products: The scraped products.
+    :type products: records.ProductBatch
+    :param complete: True if the batch is the whole result of the query, the
+                     products missing from it are then unlinked from the query,
+                     and marked as removed if no other query lists them.
+    :type complete: bool
+    :param listed: Every URL of the query result when `products` is only part of
+                   it (e.g. deduplicated across queries), default the URLs of `products`.
+    :type listed: set, None
+    """
+    now = datetime.datetime.now()
+    by_url = {product.url: product for product in products}
+    if not by_url and not listed:
+        return
+
+    # IMMEDIATE takes the write lock up front, so reading MAX(seq) and using
+    # the next values is safe even with writers in other processes.
+    with db.atomic('IMMEDIATE'):
+        seq = Product.select(fn.MAX(Product.seq)).scalar() or 0
+
+        existing = {}
+        for urls in chunked(list(by_url), 500):
+            for row in Product.select().where(Product.url.in_(urls)):
+                existing[row.url] = row
+
+        updated = []
+        created = []
+        for url, product in by_url.items():
+            content_hash = product.content_hash()
+            row = existing.get(url)
+            if row is None:
+                seq += 1
+                created.append({
+                    'name': product.name, 'price': product.price, 'url': url, 'image_url': product.image_url,
+                    'timestamp': now, 'store': store, 'query': query, 'content_hash': content_hash,
+                    'seq': seq, 'change': CHANGE_ADDED, 'removed': False,
+                })
+                continue
+            if row.content_hash == content_hash and not row.removed:
+                continue
+            seq += 1
+            if row.removed:
+                row.change = CHANGE_ADDED
+            elif row.price != product.price:
+                row.change = CHANGE_REPRICED
+            else:
+                row.change = CHANGE_UPDATED
+            row.name = product.name
+            row.price = product.price
+            row.image_url = product.image_url
+            row.timestamp = now
+            row.store = store
+            row.query = query
+            row.content_hash = content_hash
+            row.seq = seq
+            row.removed = False
+            updated.append(row)
+
+        key = query_key(query)
+        listed = set(by_url) if listed is None else set(listed)
+        linked = {
+            url for (url,) in ProductQuery.select(ProductQuery.url)
+            .where((ProductQuery.store == store) & (ProductQuery.query == key)).tuples()
+        }
+        removed = []
+        if complete:
+            dropped = list(linked - listed)
+            for urls in chunked(dropped, 500):
+                ProductQuery.delete().where(
+                    (ProductQuery.store == store) & (ProductQuery.query == key) & ProductQuery.url.in_(urls)
+                ).execute()
+            still_listed = set()
+            for urls in chunked(dropped, 500):
+                still_listed.update(url for (url,) in ProductQuery.select(ProductQuery.url).where(ProductQuery.url.in_(urls)).tuples())
+            for urls in chunked([url for url in dropped if url not in still_listed], 500):
+                for row in Product.select(Product.id, Product.url).where(Product.url.in_(urls) & (Product.removed == False)):
+                    seq += 1
+                    row.change = CHANGE_REMOVED
+                    row.removed = True
+                    row.timestamp = now
+                    row.seq = seq
+                    removed.append(row)
+        links = [{'store': store, 'query': key, 'url': url} for url in listed - linked]
+
+        if updated:
+            Product.bulk_update(updated, fields=CHANGE_FIELDS, batch_size=BATCH_SIZE)
+        if removed:
+            Product.bulk_update(removed, fields=REMOVE_FIELDS, batch_size=BATCH_SIZE)
+        for rows in chunked(created, BATCH_SIZE):
+            Product.insert_many(rows).execute()
+        for rows in chunked(links, BATCH_SIZE):
+            ProductQuery.insert_many(rows).on_conflict_ignore().execute()
+
+        observations = [
+            {'store': store, 'query': query, 'url': url, 'price': product.price, 'timestamp': now}
+            for url, product in by_url.items()
+        ]
+        for rows in chunked(observations, BATCH_SIZE):
+            PriceObservation.insert_many(rows).execute()
+
+
+def get_changes(since=0, limit=500):
+    """
+    Products added, repriced, updated or removed after a cursor.
+
+    :param since: Cursor returned by the previous call, 0 to start from the beginning.
+    :type since: int
+    :param limit: Maximum number of changes to return.
+    :type limit: int
+    :return: (changes, cursor), cursor is the seq of the last change returned,
+             or `since` if there is nothing new.
+    :rtype: tuple
+    """
+    rows = (
+        Product.select()
+        .where(Product.seq > since)
+        .order_by(Product.seq)
+        .limit(limit)
+    )
+    changes = [
+        {
+            'seq': row.seq,
+            'change': row.change,
+            'store': row.store,
+            'query': row.query,
+            'name': row.name,
+            'price': row.price,
+            'url': row.url,
+            'image_url': row.image_url,
+            'timestamp': row.timestamp.isoformat() if row.timestamp else None,
+        }
+        for row in rows
+    ]
+    cursor = changes[-1]['seq'] if changes else since
+    return changes, cursor
+
+
+class ProductWriter:
+    """
+    Single writer thread draining a bounded queue of product batches.
+
+    submit() blocks when the queue is full, flush() waits until everything
+    submitted so far is committed, close() flushes and stops the thread. close()
+    is registered with atexit, so a graceful stop never drops queued batches.
+    A batch failing with OperationalError (e.g. database is locked) is retried
+    WRITE_ATTEMPTS times with backoff; if it still fails, its URLs are logged.
+    Callbacks (price drop mails) run on a separate notifier thread, a slow
+    mail server never holds up the writes.
+    """
+    def __init__(self, queue_size=QUEUE_SIZE):
+        self._queue = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._run, name='product-writer', daemon=True)
+        self._notifier = ThreadPoolExecutor(max_workers=1, thread_name_prefix='product-notify')
+        self._closed = False
+        self._thread.start()
+
+    def submit(self, store, query, products, callback=None, complete=True, listed=None):
+        """
+        Queue a batch of products to be saved.
+
+        :param store: Store name, e.g. 'Fravega'.
+        :type store: str
+        :param query: The search query.
+        :type query: str
+        :param products: The scraped products.
+        :type products: records.ProductBatch
+        :param callback: Called without arguments on the notifier thread once the batch is committed.
+        :type callback: callable, None
+        :param complete: False if the batch may be partial (e.g. max_results), see save_products.
+        :type complete: bool
+        :param listed: Every URL of the query result, see save_products.
+        :type listed: set, None
+        """
+        if self._closed:
+            raise RuntimeError("ProductWriter is closed")
+        self._queue.put((store, query, products, callback, complete, listed))
+
+    def flush(self):
+        """
+        Wait until every submitted batch is committed.
+        """
+        self._queue.join()
+
+    def close(self):
+        """
+        Flush the queue, stop the writer thread and wait for pending callbacks.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        self._notifier.shutdown(wait=True)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                self._queue.task_done()
+                break
+            store, query, products, callback, complete, listed = item
+            try:
+                self._save(store, query, products, complete, listed)
+            except Exception as e:
+                urls = [product.url for product in products]
+                logging.error("Error saving products of %s, query %r: %s. %i products lost: %s", store, query, e, len(urls), ' '.join(urls))
+                self._queue.task_done()
+                continue
+            if callback is not None:
+                self._notifier.submit(self._notify, store, callback)
+            self._queue.task_done()
+        if not db.is_closed():
+            db.close()
+
+    def _notify(self, store, callback):
+        try:
+            callback()
+        except Exception as e:
+            logging.error("Error in save callback of %s: %s", store, e)
+
+
+    @retry(
+        retry=retry_if_exception_type(OperationalError),
+        wait=wait_exponential(multiplier=0.5, max=4),
+        stop=stop_after_attempt(WRITE_ATTEMPTS),
+        before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+        reraise=True,
+    )
+    def _save(self, store, query, products, complete, listed):
+        save_products(store, query, products, complete=complete, listed=listed)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """
+    Start the writer of this process on first use.
+
+    :return: The shared writer.
+    :rtype: ProductWriter
+    """
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = ProductWriter()
+                atexit.register(_writer.close)
+    return _writer
+
+
+def close_writer():
+    """
+    Flush pending batches and stop the writer, if it was started.
+    """
+    global _writer
+    with _writer_lock:
+        if _writer is not None:
+            _writer.close()
+            _writer = None
@@ -0,0 +1,312 @@
+"""
+Opt-in profiling of scraper runs.
+When a store changes its markup and parsing gets slow or memory hungry, run
+the scrapers with SCRAPER_PROFILE=1 (or send "X-Profile: 1" to /scrape when
+SCRAPER_PROFILE_HEADER=1 allows it). Every stage (fetch, parse, save) of every
+store then runs under cProfile and tracemalloc, and each run gets its own
+directory under SCRAPER_PROFILE_DIR (default ./profiles):
+
+    <run_id>/run.json                 run metadata and a summary of every stage
+    <run_id>/<store>-<stage>.prof     cProfile stats, open with pstats or snakeviz
+    <run_id>/<store>-<stage>.heap     tracemalloc snapshot, tracemalloc.Snapshot.load()
+
+Summarize the hotspots of every run found in the directory with:
+
+    python profiling.py [--dir profiles] [--store Perozzi] [--stage parse] [--last 10] [--top 20]
+
+Profiled runs are not pipelined: stages run one after the other in the calling
+thread (see scrapers.pipeline.run_profiled), so each profile covers one stage of
+one store. When profiling is off the regular pipeline runs untouched.
+"""
+import argparse
+import cProfile
+import json
+import logging
+import os
+import platform
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from contextlib import contextmanager
+from datetime import datetime
+
+
+def _flag(name):
+    return os.environ.get(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+ENABLED = _flag('SCRAPER_PROFILE')
+HEADER_ENABLED = _flag('SCRAPER_PROFILE_HEADER')
+PROFILE_DIR = os.environ.get('SCRAPER_PROFILE_DIR', 'profiles')
+PROFILE_HEADER = 'X-Profile'
+
+METADATA_FILE = 'run.json'
+# Allocation sites kept in run.json per stage, the full snapshot is in the .heap file.
+TOP_ALLOCATIONS = 25
+TRACEMALLOC_FRAMES = 1
+
+# tracemalloc is process wide, profiled stages of concurrent runs take turns.
+_stage_lock = threading.Lock()
+
+
+def header_requested(headers):
+    """
+    Tell whether a request asks to be profiled.
+
+    :param headers: Request headers.
+    :type headers: werkzeug.datastructures.Headers, dict
+    :return: True if the X-Profile header is set and SCRAPER_PROFILE_HEADER allows it.
+    :rtype: bool
+    """
+    if not HEADER_ENABLED:
+        return False
+    return headers.get(PROFILE_HEADER, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _slug(text):
+    return re.sub(r'[^A-Za-z0-9_.]+', '_', str(text)).strip('_') or 'unknown'
+
+
+class RunProfiler:
+    """
+    Collects the CPU profile and allocation snapshot of every stage of one run.
+
+    :param query: The search query of the run.
+    :type query: str
+    :param stores: Stores taking part in the run.
+    :type stores: list
+    :param source: What started the run, e.g. 'run' or '/scrape'.
+    :type source: str
+    :param directory: Parent directory of the run directories.
+    :type directory: str
+    """
+    def __init__(self, query, stores, source='run', directory=None):
+        started_at = datetime.now()
+        self.run_id = f'{started_at:%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:6]}'
+        self.directory = os.path.join(directory or PROFILE_DIR, self.run_id)
+        self.metadata = {
+            'run_id': self.run_id,
+            'source': source,
+            'query': query,
+            'stores': list(stores),
+            'started_at': started_at.isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pid': os.getpid(),
+            'argv': sys.argv,
+            'stages': [],
+        }
+        self._started = time.perf_counter()
+        os.makedirs(self.directory, exist_ok=True)
+
+    @contextmanager
+    def stage(self, stage, store):
+        """
+        Profile the body of the with block as one stage of one store.
+
+        :param stage: Stage name, 'fetch', 'parse' or 'save'.
+        :type stage: str
+        :param store: Store name.
+        :type store: str
+        """
+        with _stage_lock:
+            tracing = tracemalloc.is_tracing()
+            if tracing:
+                baseline = tracemalloc.take_snapshot()
+            else:
+                tracemalloc.start(TRACEMALLOC_FRAMES)
+            tracemalloc.reset_peak()
+
+            error = None
+            profile = cProfile.Profile()
+            started = time.perf_counter()
+            profile.enable()
+            try:
+                yield
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                profile.disable()
+                elapsed = time.perf_counter() - started
+                current, peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, '<frozen importlib._bootstrap*>'),
+                ))
+                if not tracing:
+                    tracemalloc.stop()
+                    top = snapshot.statistics('lineno')
+                else:
+                    top = snapshot.compare_to(baseline, 'lineno')
+                self._record(stage, store, elapsed, peak, current, profile, snapshot, top, error)
+
+    def _record(self, stage, store, elapsed, peak, current, profile, snapshot, top, error):
+        name = f'{_slug(store)}-{_slug(stage)}'
+        profile.dump_stats(os.path.join(self.directory, f'{name}.prof'))
+        snapshot.dump(os.path.join(self.directory, f'{name}.heap'))
+        self.metadata['stages'].append({
+            'stage': stage,
+            'store': store,
+            'elapsed': round(elapsed, 6),
+            'peak_bytes': peak,
+            'retained_bytes': current,
+            'profile': f'{name}.prof',
+            'snapshot': f'{name}.heap',
+            'error': repr(error) if error is not None else None,
+            'top_allocations': [
+                {
+                    'where': f'{stat.traceback[0].filename}:{stat.traceback[0].lineno}',
+                    'size': getattr(stat, 'size_diff', stat.size),
+                    'count': getattr(stat, 'count_diff', stat.count),
+                }
+                for stat in top[:TOP_ALLOCATIONS]
+            ],
+        })
+
+    def finish(self, error=None):
+        """
+        Write the run metadata.
+
+        :param error: The error that stopped the run, if any.
+        :type error: Exception, None
+        :return: Path of the run directory.
+        :rtype: str
+        """
+        self.metadata['elapsed'] = round(time.perf_counter() - self._started, 6)
+        self.metadata['error'] = repr(error) if error is not None else None
+        with open(os.path.join(self.directory, METADATA_FILE), 'w', encoding='utf-8') as file:
+            json.dump(self.metadata, file, indent=2)
+        logging.info("Profile of run %s written to %s", self.run_id, self.directory)
+        return self.directory
+
+
+@contextmanager
+def profile_run(query, stores, source='run', directory=None):
+    """
+    Create a RunProfiler and write its metadata when the with block exits.
+
+    :return: The profiler, pass it to scrapers.pipeline.run_profiled.
+    :rtype: RunProfiler
+    """
+    profiler = RunProfiler(query, stores, source=source, directory=directory)
+    try:
+        yield profiler
+    except BaseException as e:
+        profiler.finish(error=e)
+        raise
+    profiler.finish()
+
+
+def load_runs(directory=None, store=None, stage=None, last=None):
+    """
+    Load the metadata of the profiled runs, oldest first.
+
+    :param directory: Parent directory of the run directories, default PROFILE_DIR.
+    :type directory: str, None
+    :param store: Only keep the stages of this store.
+    :type store: str, None
+    :param stage: Only keep this stage.
+    :type stage: str, None
+    :param last: Only keep the last N runs.
+    :type last: int, None
+    :return: Run metadata, each with 'directory' set and its 'stages' filtered,
+             runs left without stages are skipped.
+    :rtype: list
+    """
+    directory = directory or PROFILE_DIR
+    runs = []
+    if not os.path.isdir(directory):
+        return runs
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name, METADATA_FILE)
+        if not os.path.isfile(path):
+            continue
+        try:
+            with open(path, encoding='utf-8') as file:
+                run = json.load(file)
+        except (OSError, ValueError) as e:
+            logging.warning("Skipping profile %s: %s", path, e)
+            continue
+        run['directory'] = os.path.dirname(path)
+        run['stages'] = [
+            item for item in run.get('stages', [])
+            if (store is None or item['store'].lower() == store.lower()) and (stage is None or item['stage'] == stage)
+        ]
+        if run['stages']:
+            runs.append(run)
+    return runs[-last:] if last else runs
+
+
+def summarize(runs, top=20, sort='tottime', stream=None):
+    """
+    Print per stage timings, the CPU hotspots and the allocation hotspots of the given runs.
+
+    :param runs: Runs returned by load_runs.
+    :type runs: list
+    :param top: Number of functions and allocation sites to print.
+    :type top: int
+    :param sort: pstats sort key, e.g. 'tottime' or 'cumulative'.
+    :type sort: str
+    :param stream: Output stream, default sys.stdout.
+    """
+    stream = stream or sys.stdout
+    stages = [(run, item) for run in runs for item in run['stages']]
+    if not stages:
+        print("No profiled stages found.", file=stream)
+        return
+
+    print(f"{len(runs)} runs, {len(stages)} stages\n", file=stream)
+    print(f"{'store':<12} {'stage':<6} {'runs':>5} {'mean s':>9} {'max s':>9} {'max peak MB':>12}", file=stream)
+    groups = {}
+    for _, item in stages:
+        groups.setdefault((item['store'], item['stage']), []).append(item)
+    for (store, stage), items in sorted(groups.items()):
+        times = [item['elapsed'] for item in items]
+        peak = max(item['peak_bytes'] for item in items) / 2 ** 20
+        print(f"{store:<12} {stage:<6} {len(items):>5} {sum(times) / len(times):>9.3f} {max(times):>9.3f} {peak:>12.1f}", file=stream)
+
+    print("\nCPU hotspots", file=stream)
+    stats = None
+    for run, item in stages:
+        path = os.path.join(run['directory'], item['profile'])
+        if not os.path.isfile(path):
+            continue
+        if stats is None:
+            stats = pstats.Stats(path, stream=stream)
+        else:
+            stats.add(path)
+    if stats is not None:
+        stats.strip_dirs().sort_stats(sort).print_stats(top)
+
+    print("Allocation hotspots (retained at the end of each stage)", file=stream)
+    sites = {}
+    for _, item in stages:
+        for allocation in item['top_allocations']:
+            site = sites.setdefault(allocation['where'], [0, 0, 0])
+            site[0] += allocation['size']
+            site[1] += allocation['count']
+            site[2] += 1
+    print(f"{'KiB':>10} {'blocks':>9} {'stages':>7}  where", file=stream)
+    for where, (size, count, seen) in sorted(sites.items(), key=lambda site: -site[1][0])[:top]:
+        print(f"{size / 1024:>10.1f} {count:>9} {seen:>7}  {where}", file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the hotspots of profiled scraper runs.")
+    parser.add_argument('--dir', default=PROFILE_DIR, help="profiles directory (default: %(default)s)")
+    parser.add_argument('--store', help="only this store, e.g. Perozzi")
+    parser.add_argument('--stage', choices=('fetch', 'parse', 'save'), help="only this stage")
+    parser.add_argument('--last', type=int, help="only the last N runs")
+    parser.add_argument('--top', type=int, default=20, help="hotspots to print (default: %(default)s)")
+    parser.add_argument('--sort', default='tottime', help="pstats sort key (default: %(default)s)")
+    args = parser.parse_args(argv)
+    summarize(load_runs(args.dir, store=args.store, stage=args.stage, last=args.last), top=args.top, sort=args.sort)
+
+
+if __name__ == '__main__':
+    main()
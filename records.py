@@ -0,0 +1,206 @@
+"""
+Compact product records.
+Scrapers used to build one dict per product; big result pages produce tens of
+thousands of them. ProductRecord is a slotted object whose store and URL
+prefixes (scheme + host) are interned, and ProductBatch keeps a whole result
+set in columns, so a page of products is a handful of lists and arrays.
+"""
+import hashlib
+import sys
+from array import array
+
+FIELDS = ('name', 'price', 'url', 'image_url')
+ALL_FIELDS = FIELDS + ('store',)
+
+
+def split_url(url):
+    """
+    Split a URL into its interned prefix (scheme and host) and its path.
+
+    :param url: Absolute or relative URL.
+    :type url: str
+    :return: (prefix, path), prefix + path == url.
+    :rtype: tuple
+    """
+    start = url.find('//')
+    index = url.find('/', start + 2) if start != -1 else -1
+    if index == -1:
+        return '', url
+    return sys.intern(url[:index]), url[index:]
+
+
+class ProductRecord:
+    """
+    One product as scraped from a store.
+    """
+    __slots__ = ('name', 'price', 'store', 'url_prefix', 'url_path', 'image_prefix', 'image_path')
+
+    def __init__(self, name, price, url, image_url, store=None):
+        self.name = name
+        self.price = price
+        self.store = sys.intern(store) if store else store
+        self.url_prefix, self.url_path = split_url(url)
+        self.image_prefix, self.image_path = split_url(image_url or '')
+
+    @property
+    def url(self):
+        return self.url_prefix + self.url_path
+
+    @property
+    def image_url(self):
+        return self.image_prefix + self.image_path
+
+    def content_hash(self):
+        """
+        :return: Short digest of the name, price and image URL, used to detect changes.
+        :rtype: str
+        """
+        content = f'{self.name}\x1f{self.price!r}\x1f{self.image_url}'
+        return hashlib.blake2b(content.encode('utf-8'), digest_size=8).hexdigest()
+
+    def to_dict(self, fields=FIELDS):
+        """
+        :param fields: Fields to include, default name, price, url and image_url.
+        :type fields: tuple
+        :return: The record as a JSON serializable dictionary.
+        :rtype: dict
+        """
+        return {field: getattr(self, field) for field in fields}
+
+    def __repr__(self):
+        return f'ProductRecord(name={self.name!r}, price={self.price!r}, url={self.url!r}, store={self.store!r})'
+
+
+class ProductBatch:
+    """
+    Columnar container for the products of one store.
+    Prices live in an array of doubles and URL prefixes are stored once per
+    batch and referenced by index, records are only created when iterating.
+    The batch pickles as plain lists and arrays, cheap to send between processes.
+    """
+    __slots__ = ('store', 'names', 'prices', 'prefixes', 'url_prefixes', 'url_paths', 'image_prefixes', 'image_paths', '_prefix_index')
+
+    def __init__(self, store=None):
+        self.store = sys.intern(store) if store else store
+        self.names = []
+        self.prices = array('d')
+        self.prefixes = []
+        self.url_prefixes = array('I')
+        self.url_paths = []
+        self.image_prefixes = array('I')
+        self.image_paths = []
+        self._prefix_index = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        for index in range(len(self.names)):
+            yield self[index]
+
+    def __getitem__(self, index):
+        prefixes = self.prefixes
+        record = ProductRecord.__new__(ProductRecord)
+        record.name = self.names[index]
+        record.price = self.prices[index]
+        record.store = self.store
+        record.url_prefix = prefixes[self.url_prefixes[index]]
+        record.url_path = self.url_paths[index]
+        record.image_prefix = prefixes[self.image_prefixes[index]]
+        record.image_path = self.image_paths[index]
+        return record
+
+    def __getstate__(self):
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+    def __setstate__(self, state):
+        for slot, value in state.items():
+            setattr(self, slot, value)
+        self.prefixes = [sys.intern(prefix) for prefix in self.prefixes]
+
+    def _prefix_id(self, prefix):
+        prefix_id = self._prefix_index.get(prefix)
+        if prefix_id is None:
+            prefix_id = self._prefix_index[prefix] = len(self.prefixes)
+            self.prefixes.append(sys.intern(prefix))
+        return prefix_id
+
+    def append(self, name, price, url, image_url):
+        """
+        Add a product to the batch.
+
+        :param name: Product name.
+        :type name: str
+        :param price: Product price.
+        :type price: float
+        :param url: Product URL.
+        :type url: str
+        :param image_url: Product image URL.
+        :type image_url: str
+        """
+        url_prefix, url_path = split_url(url)
+        image_prefix, image_path = split_url(image_url or '')
+        self.names.append(name)
+        self.prices.append(price)
+        self.url_prefixes.append(self._prefix_id(url_prefix))
+        self.url_paths.append(url_path)
+        self.image_prefixes.append(self._prefix_id(image_prefix))
+        self.image_paths.append(image_path)
+
+    def extend(self, products):
+        """
+        Add the products of another batch (or any iterable of records).
+        """
+        for product in products:
+            self.append(product.name, product.price, product.url, product.image_url)
+
+    def urls(self):
+        """
+        :return: The URL of every product, in order.
+        :rtype: list
+        """
+        prefixes = self.prefixes
+        return [prefixes[prefix] + path for prefix, path in zip(self.url_prefixes, self.url_paths)]
+
+    def digest(self):
+        """
+        :return: Digest of the store and every product, in order. Equal batches
+                 have equal digests, whatever order their prefixes were interned in.
+        :rtype: bytes
+        """
+        prefixes = self.prefixes
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f'{self.store}\x1e{len(self.names)}\x1e'.encode('utf-8'))
+        digest.update(self.prices.tobytes())
+        for name, url_prefix, url_path, image_prefix, image_path in zip(
+            self.names, self.url_prefixes, self.url_paths, self.image_prefixes, self.image_paths
+        ):
+            row = f'{name}\x1f{prefixes[url_prefix]}{url_path}\x1f{prefixes[image_prefix]}{image_path}\x1e'
+            digest.update(row.encode('utf-8'))
+        return digest.digest()
+
+    def to_dicts(self, fields=FIELDS, start=0, stop=None):
+        """
+        Serialize the batch straight from its columns, without building records.
+
+        :param fields: Fields to include, default name, price, url and image_url.
+        :type fields: tuple
+        :param start: Index of the first product to serialize.
+        :type start: int
+        :param stop: Index after the last product to serialize, default the end.
+        :type stop: int, None
+        :return: One JSON serializable dictionary per product.
+        :rtype: list
+        """
+        prefixes = self.prefixes
+        window = slice(start, stop)
+        names = self.names[window]
+        columns = {
+            'name': names,
+            'price': self.prices[window],
+            'url': [prefixes[prefix] + path for prefix, path in zip(self.url_prefixes[window], self.url_paths[window])] if 'url' in fields else None,
+            'image_url': [prefixes[prefix] + path for prefix, path in zip(self.image_prefixes[window], self.image_paths[window])] if 'image_url' in fields else None,
+            'store': [self.store] * len(names) if 'store' in fields else None,
+        }
+        selected = [columns[field] for field in fields]
+        return [dict(zip(fields, row)) for row in zip(*selected)]
@@ -0,0 +1,203 @@
+"""
+Fast JSON responses.
+Bodies are encoded with orjson when it is installed, compressed with brotli or
+gzip according to Accept-Encoding, and tagged with an ETag so clients holding
+the same result set get a 304 instead of the whole body again.
+Paginated results are kept for a few minutes in ResultSets, the cursor of the
+next page points at the stored result instead of requiring a new scrape.
+"""
+import base64
+import gzip
+import hashlib
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Smaller bodies are not worth the compression CPU.
+MIN_COMPRESS_SIZE = 1024
+GZIP_LEVEL = 5
+BROTLI_QUALITY = 4
+
+# Result sets paged with cursors live this long after their last page request.
+RESULT_TTL = 300
+MAX_RESULT_SETS = 64
+
+
+def dumps(payload):
+    """
+    Encode a payload as compact JSON.
+
+    :param payload: Any JSON serializable object.
+    :return: UTF-8 encoded JSON.
+    :rtype: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(payload)
+    return json.dumps(payload, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def _accepted_encodings():
+    accepted = set()
+    for part in request.headers.get('Accept-Encoding', '').split(','):
+        encoding, _, params = part.strip().partition(';')
+        if params.replace(' ', '') in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000'):
+            continue
+        accepted.add(encoding.strip().lower())
+    return accepted
+
+
+def _etag_matches(etag):
+    if_none_match = request.headers.get('If-None-Match', '')
+    if if_none_match.strip() == '*':
+        return True
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        # Compressed representations carry a suffix, the content is the same.
+        if tag.strip('"').split('-', 1)[0] == etag:
+            return True
+    return False
+
+
+def json_response(payload, status=200):
+    """
+    Build a JSON response with ETag, 304 and content negotiation.
+
+    :param payload: Any JSON serializable object.
+    :param status: HTTP status code.
+    :type status: int
+    :rtype: flask.Response
+    """
+    body = dumps(payload)
+    etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+    headers = {'Vary': 'Accept-Encoding'}
+
+    if status == 200 and _etag_matches(etag):
+        headers['ETag'] = f'"{etag}"'
+        return Response(status=304, headers=headers)
+
+    encoding = None
+    if len(body) >= MIN_COMPRESS_SIZE:
+        accepted = _accepted_encodings()
+        if brotli is not None and 'br' in accepted:
+            encoding = 'br'
+            body = brotli.compress(body, quality=BROTLI_QUALITY)
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+            body = gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        headers['ETag'] = f'"{etag}-{encoding}"'
+    else:
+        headers['ETag'] = f'"{etag}"'
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+
+def encode_cursor(result_id, offset):
+    """
+    :param result_id: Id of the result set returned by ResultSets.put.
+    :type result_id: str
+    :param offset: Offset of the first item of the next page.
+    :type offset: int
+    :return: Opaque cursor for the next page.
+    :rtype: str
+    """
+    return base64.urlsafe_b64encode(f'{result_id}:{offset}'.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """
+    :param cursor: Cursor returned by a previous page.
+    :type cursor: str
+    :return: (result_id, offset) of the page.
+    :rtype: tuple
+    :raises ValueError: If the cursor is not valid.
+    """
+    if not isinstance(cursor, str) or not cursor:
+        raise ValueError("cursor must be a non empty string")
+    padded = cursor + '=' * (-len(cursor) % 4)
+    result_id, _, offset = base64.urlsafe_b64decode(padded.encode()).decode().rpartition(':')
+    offset = int(offset)
+    if not result_id or offset < 0:
+        raise ValueError("invalid cursor")
+    return result_id, offset
+
+
+class ResultSets:
+    """
+    Short-lived store of the result sets being paged through, in this process.
+    An entry expires `ttl` seconds after it was last read, the oldest entries
+    are dropped past `max_size`.
+
+    :param ttl: Seconds an entry is kept after its last use.
+    :type ttl: int
+    :param max_size: Maximum number of entries.
+    :type max_size: int
+    """
+    def __init__(self, ttl=RESULT_TTL, max_size=MAX_RESULT_SETS):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, value, content=None):
+        """
+        :param value: The result set.
+        :param content: Bytes identifying the content of the result set. Equal
+                        content gets the same id, so the cursors, the response
+                        body and its ETag stay the same while the result does not
+                        change. Default a random id.
+        :type content: bytes, None
+        :return: Id of the stored result set, for encode_cursor.
+        :rtype: str
+        """
+        if content is None:
+            result_id = secrets.token_urlsafe(12)
+        else:
+            result_id = base64.urlsafe_b64encode(hashlib.blake2b(content, digest_size=12).digest()).decode()
+        with self._lock:
+            self._expire()
+            self._items.pop(result_id, None)
+            self._items[result_id] = (time.monotonic() + self.ttl, value)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return result_id
+
+    def get(self, result_id):
+        """
+        :param result_id: Id returned by put.
+        :type result_id: str
+        :return: The result set, None if it expired or is unknown.
+        """
+        with self._lock:
+            self._expire()
+            item = self._items.pop(result_id, None)
+            if item is None:
+                return None
+            self._items[result_id] = (time.monotonic() + self.ttl, item[1])
+            return item[1]
+
+    def _expire(self):
+        # Entries are kept in expiry order, every use moves one to the end.
+        now = time.monotonic()
+        while self._items:
+            result_id, (expires, _) = next(iter(self._items.items()))
+            if expires > now:
+                break
+            del self._items[result_id]
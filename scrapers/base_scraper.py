@@ -1,41 +1,121 @@
-import datetime
+import functools
 import logging
 import os
 import random
 import smtplib
+import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
+from urllib.parse import urlsplit
 from requests.exceptions import RequestException
-from models import Product, create_tables
-from dotenv import load_dotenv
+from persistence import get_writer, save_products
+from records import ProductBatch
 
 import requests
-from bs4 import BeautifulSoup
-from diskcache import Cache
+from requests.adapters import HTTPAdapter
 from tenacity import retry, wait_fixed, stop_after_attempt
 
 from tools_api import load_json_file
 
-load_dotenv()
-cache = Cache("/cache_directory/")
-PROXIES = load_json_file('proxies.json')
-USER_AGENT = load_json_file('user_agents.json')
+# Shared resources (HTML cache, proxies, User-Agents, .env, logging handlers) are
+# initialized on first use instead of at import time, so importing a scraper is
+# cheap and each worker process only opens what it actually needs.
+_cache = None
+_cache_lock = threading.Lock()
 
+# Maximum concurrent requests to the same store, shared by every scraper of the process.
+HOST_LIMIT = 4
+_host_slots = {}
+_host_slots_lock = threading.Lock()
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(module)s - %(lineno)d - %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler("scraper.log", mode="w")
-    ]
-)
+_session = None
+_session_lock = threading.Lock()
 
-console_handler = logging.StreamHandler()
-console_handler.setLevel(logging.INFO)
-console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-logging.getLogger().addHandler(console_handler)
+# Seconds before giving up on the mail server, notifications must never hang a thread.
+SMTP_TIMEOUT = 30
+
+
+def get_cache():
+    """
+    Open the HTML disk cache on first use.
+
+    :return: The shared cache of this process.
+    :rtype: diskcache.Cache
+    """
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                from diskcache import Cache
+                _cache = Cache("/cache_directory/")
+    return _cache
+
+
+def get_host_slot(url):
+    """
+    Semaphore limiting the concurrent requests to the host of `url`.
+
+    :param url: URL about to be requested.
+    :type url: str
+    :rtype: threading.BoundedSemaphore
+    """
+    host = urlsplit(url).netloc
+    with _host_slots_lock:
+        slot = _host_slots.get(host)
+        if slot is None:
+            slot = _host_slots[host] = threading.BoundedSemaphore(HOST_LIMIT)
+    return slot
+
+
+def get_session():
+    """
+    HTTP session shared by every scraper of the process, so requests to the
+    same store reuse kept-alive connections.
+
+    :rtype: requests.Session
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=16, pool_maxsize=HOST_LIMIT)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                _session = session
+    return _session
+
+
+@functools.lru_cache(maxsize=None)
+def get_proxies():
+    return load_json_file('proxies.json')
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_agents():
+    return load_json_file('user_agents.json')
+
+
+@functools.lru_cache(maxsize=None)
+def configure_logging():
+    """
+    Install the log handlers, call it once from the entry point (app.py, main.py).
+    """
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(module)s - %(lineno)d - %(message)s',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler("scraper.log", mode="w")
+        ]
+    )
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.INFO)
+    console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+    logging.getLogger().addHandler(console_handler)
 
 
 def send_email_notification(subject, body):
@@ -46,6 +126,9 @@ def send_email_notification(subject, body):
 
     and then setting your From and To
     """
+    from dotenv import load_dotenv
+
+    load_dotenv()
     your_username = os.getenv("YOUR_USERNAME")
     your_password = os.getenv("YOUR_PASSWORD")
     msg = EmailMessage()
@@ -56,7 +139,7 @@ def send_email_notification(subject, body):
     msg['To'] = 'to_email@example.com'
 
     
-    with smtplib.SMTP_SSL('smtp.example.com', 465) as server:
+    with smtplib.SMTP_SSL('smtp.example.com', 465, timeout=SMTP_TIMEOUT) as server:
         server.login(your_username, your_password)
         server.send_message(msg)
 
@@ -67,11 +150,33 @@ class BaseScraper(ABC):
     """
     Class base for all scrapers of sites.
     Provides common method for all sub-class
-    
+
+    Paginated stores set results_per_page and implement page_url() and
+    is_last_page(), the pages are then fetched in parallel by fetch_pages().
+    max_pages is only a safety net against stores that never report a last
+    page (30000 Perozzi products). A run stopped by it, or that skipped a
+    broken page, sets `truncated`.
     """
-    def __init__(self, query):
+    store = None
+    results_per_page = None
+    max_pages = 500
+
+    def __init__(self, query, max_results=None):
         self.query = query
-        self.products = []
+        self.max_results = max_results
+        self.truncated = False
+        self.products = ProductBatch(self.store)
+
+    @property
+    def complete(self):
+        """
+        True if self.products is the whole result of the query: not cut by
+        max_results and not truncated. Only a complete result marks the products
+        missing from it as removed.
+
+        :rtype: bool
+        """
+        return not (self.max_results or self.truncated)
 
     
     def format_query(self,query:str)->str:
@@ -92,7 +197,7 @@ class BaseScraper(ABC):
         :return: A random proxy.
         :rtype: str
         """
-        return random.choice(PROXIES)
+        return random.choice(get_proxies())
     
 
     def get_user_agent(self):
@@ -102,7 +207,7 @@ class BaseScraper(ABC):
         :return: A random User-Agent.
         :rtype: str
         """
-        return random.choice(USER_AGENT)
+        return random.choice(get_user_agents())
     
     @retry(wait=wait_fixed(3), stop=stop_after_attempt(3))
     def get_html_from_url(self,url):
@@ -115,6 +220,7 @@ class BaseScraper(ABC):
                     Otherwise, None.
         :rtype: str, None
         """
+        cache = get_cache()
         cached_html = cache.get(url)
         if cached_html is not None:
             logging.info("Retrieved cache HTML for URL: %s", url)
@@ -122,29 +228,44 @@ class BaseScraper(ABC):
         
         headers = {"User-Agent": self.get_user_agent()}
         try:
-            session = requests.Session()
-            response = session.get(url, headers=headers)
+            with get_host_slot(url):
+                response = get_session().get(url, headers=headers)
+            # 429 and 5xx pages are retried, never cached as results.
+            response.raise_for_status()
             cache.set(url,response.text, expire=86400) #expire cache 1 day(in seconds)
             return response.text
         except requests.RequestException as e:
-            logging.error("Error fetching the page: %i", response.status_code)
+            logging.error("Error fetching the page: %s", e)
             raise e
 
 
-    def save_product(self, product_data):
+    def save_product(self, product):
+        """
+        Save the product data into the database, synchronously.
+
+        :param product: The scraped product.
+        :type product: records.ProductRecord
+        """
+        save_products(self.store, self.query, [product])
+
+    def notify_price_drops(self, threshold=0.1):
         """
-        Save the product data into the database.
+        Send an email notification listing the products of this store and query
+        whose latest price dropped at least `threshold` below their recent average.
+        Only drops that happened at the latest scrape are sent, each drop is mailed once.
 
-        :param product_data: Dictionary containing product data.
-        :type product_data: dict
+        :param threshold: Minimum relative drop, 0.1 means 10% cheaper.
+        :type threshold: float
         """
-        product, created = Product.get_or_create(url=product_data['url'], defaults=product_data)
+        from analytics import load_observations, detect_drops
 
-        if not created:
-            product.price = product_data['price']
-            product.image_url = product_data['image_url']
-            product.timestamp = datetime.datetime.now()
-            product.save()
+        # Only drops that just happened, a price staying down is not mailed again.
+        drops = detect_drops(load_observations(store=self.store, query=self.query), threshold=threshold, new_only=True)
+        if not drops:
+            return
+        logging.info("%s: %i price drops detected", self.store, len(drops))
+        body = "\n".join(f"{drop['url']}: ${drop['baseline']} -> ${drop['price']} (-{drop['drop']:.0%})" for drop in drops)
+        send_email_notification(f"Price drops on {self.store}: {self.query}", body)
 
         
 
@@ -165,6 +286,82 @@ class BaseScraper(ABC):
             raise e
 
 
+    def page_url(self, page):
+        """
+        URL of a results page, paginated scrapers must override it.
+
+        :param page: Page number, starting at 1.
+        :type page: int
+        :return: The URL of the page, None if the store is not paginated.
+        :rtype: str, None
+        """
+        return None
+
+
+    def is_last_page(self, html):
+        """
+        Tell whether a results page is the last one, without parsing it.
+
+        :param html: The HTML content of a results page.
+        :type html: str
+        :rtype: bool
+        """
+        return True
+
+
+    def fetch_page(self, page):
+        """
+        Fetch the HTML content of a results page.
+
+        :param page: Page number, starting at 1.
+        :type page: int
+        :rtype: str
+        """
+        return self.get_html_from_url(self.page_url(page))
+
+
+    def fetch_pages(self):
+        """
+        Fetch every results page, up to max_pages and max_results.
+        Pages are requested in parallel, HOST_LIMIT at a time, and returned in
+        order; everything after the first page detected as last is dropped.
+        Stopping at max_pages before the last page sets `truncated` and logs a warning.
+
+        :return: The HTML content of each results page.
+        :rtype: list
+        """
+        if self.page_url(1) is None:
+            return [self.fetch_results()]
+
+        self.truncated = False
+        wanted = None
+        if self.max_results and self.results_per_page:
+            wanted = -(-self.max_results // self.results_per_page)
+        page_limit = self.max_pages if wanted is None else min(self.max_pages, wanted)
+
+        pages = [self.fetch_page(1)]
+        if self.is_last_page(pages[0]):
+            return pages
+
+        with ThreadPoolExecutor(max_workers=HOST_LIMIT) as executor:
+            next_page = 2
+            while next_page <= page_limit:
+                window = range(next_page, min(next_page + HOST_LIMIT, page_limit + 1))
+                for html in executor.map(self.fetch_page, window):
+                    # Some stores answer past the end with the last page again.
+                    if html == pages[-1]:
+                        return pages
+                    pages.append(html)
+                    if self.is_last_page(html):
+                        return pages
+                next_page = window.stop
+
+        if wanted is None or wanted > self.max_pages:
+            self.truncated = True
+            logging.warning("%s: stopped at max_pages=%i, results for %s are incomplete", self.__class__.__name__, self.max_pages, self.query)
+        return pages
+
+
     @abstractmethod
     def parse_results(self,html):
         """
@@ -176,35 +373,85 @@ class BaseScraper(ABC):
         pass
 
 
-    def run(self, send_notifications=False):
+    def parse(self, html):
+        """
+        Parse stage of the pipeline, runs in a worker process.
+
+        :param html: The HTML content of the search results page.
+        :type html: str
+        :return: The products found on the page.
+        :rtype: records.ProductBatch
+        """
+        self.products = ProductBatch(self.store)
+        self.parse_results(html)
+        return self.products
+
+
+    def save(self, send_notifications=False, products=None):
+        """
+        Save stage of the pipeline: hand the products to the write-behind writer
+        and return without waiting for the database.
+
+        :param send_notifications: If True, send email notifications on price drops once saved.
+        :type send_notifications: bool
+        :param products: Products to save, default self.products.
+        :type products: records.ProductBatch, None
+        """
+        callback = self.notify_price_drops if send_notifications else None
+        listed = None
+        if products is None:
+            products = self.products
+        else:
+            listed = set(self.products.urls())
+        # A partial result (max_results, max_pages, skipped page) removes nothing.
+        get_writer().submit(self.store, self.query, products, callback=callback, complete=self.complete, listed=listed)
+
+
+    def handle_error(self, error, send_notifications=False):
+        """
+        Log a ScraperError and send email notification if send_notifications is set to True.
+
+        :param error: The error raised while parsing.
+        :type error: ScraperError
+        :param send_notifications: If True, send email notifications on error.
+        :type send_notifications: bool
+        """
+        logging.error("Error on run() scraper: %s", error.scraper)
+        logging.error("Message error: %s", error.message)
+        if send_notifications:
+            send_email_notification(f"Error trying to run: {error.scraper}", f"Message error: {error.message}")
+
+
+    def run(self, send_notifications=False, profile=None):
         """
         Run the scraper, fetch the HTML content, parse the results, and save the product data. If the structure change and have error,
-        then send email notification if send_notifications is set to True.
-        Create your .env and put: 
+        then send email notification if send_notifications is set to True, the same for price drops.
+        Create your .env and put:
         YOUR_USERNAME=
         YOUR_PASSWORD=
-        :param send_notifications: If True, send email notifications on error. Default is False.
+        The stages run through scrapers.pipeline, use run_pipeline() directly to run many scrapers at once.
+        :param send_notifications: If True, send email notifications on error and on price drops. Default is False.
         :type send_notifications: bool
+        :param profile: If True, profile every stage and write the profiles to the
+                        profiles directory (see profiling.py). Default is the SCRAPER_PROFILE setting.
+        :type profile: bool, None
         """
-        try:
-            start_time = time.time()
-            logging.info("Starting scraper: %s", self.__class__.__name__)
-            html = self.fetch_results()
-            self.parse_results(html)
-            for product in self.products:
-                self.save_product(product)
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            logging.info("Scraper finished: %s, elapsed time: %.2f seconds", self.__class__.__name__, elapsed_time)
-        except ScraperError as e:
-            logging.error("Error on run() scraper: %s", e.scraper)
-            logging.error("Message error: %s", e.message)
-            if send_notifications:
-                send_email_notification(f"Error trying to run: {e.scraper}", f"Message error: {e.message}")
+        import profiling
+        from scrapers.pipeline import run_pipeline, run_profiled
+
+        if not (profiling.ENABLED if profile is None else profile):
+            run_pipeline([self], send_notifications=send_notifications)
+            return
+        with profiling.profile_run(self.query, [self.store]) as profiler:
+            run_profiled([self], profiler, send_notifications=send_notifications)
 
 
 class ScraperError(Exception):
     def __init__(self, message, scraper):
         self.message = message
         self.scraper = scraper
-        super().__init__(message)
\ No newline at end of file
+        super().__init__(message)
+
+    def __reduce__(self):
+        # Parse errors are raised in worker processes and pickled back.
+        return self.__class__, (self.message, self.scraper)
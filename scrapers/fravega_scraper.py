@@ -3,24 +3,30 @@ from scrapers.base_scraper import BaseScraper, ScraperError
 from bs4 import BeautifulSoup
 
 class FravegaScraper(BaseScraper):
-    
-    def __init__(self, query: str):
-        self.query = self.format_query(query)
-        self.products = []
+    store = 'Fravega'
+    results_per_page = 15
+
+    def __init__(self, query: str, max_results=None):
+        super().__init__(self.format_query(query), max_results=max_results)
 
     def format_query(self, query: str) -> str:
         return query.replace(" ", "%20")
     
 
+    def page_url(self, page):
+        return f'https://www.fravega.com/l/?keyword={self.query}&page={page}'
+
+    def is_last_page(self, html):
+        return html.count('data-test-id="result-item"') < self.results_per_page
+
     def fetch_results(self):
         """
-        Fetch the HTML content of the Fravega search results page.
+        Fetch the HTML content of the first Fravega search results page.
 
         :return: The HTML content of the Fravega search results page.
         :rtype: str
         """
-        url = f'https://www.fravega.com/l/?keyword={self.query}'
-        return self.get_html_from_url(url)
+        return self.fetch_page(1)
     
 
     def parse_results(self, html):
@@ -38,10 +44,9 @@ class FravegaScraper(BaseScraper):
         logging.info('Fravega: Quantity of products found: %i', len(product_list))
 
         for product in product_list:
-            product_data = {
-                'name': product.find('span', class_='sc-6321a7c8-0').text.strip(),
-                'price': float(product.find('span', class_='sc-ad64037f-0').text.replace('$', '').replace('.', '').replace(',', '.')),
-                'url': 'https://www.fravega.com' + product.find('a')['href'],
-                'image_url': product.find('img', class_='sc-3c31b0ed-0')['src']
-            }
-            self.products.append(product_data)
\ No newline at end of file
+            self.products.append(
+                name=product.find('span', class_='sc-6321a7c8-0').text.strip(),
+                price=float(product.find('span', class_='sc-ad64037f-0').text.replace('$', '').replace('.', '').replace(',', '.')),
+                url='https://www.fravega.com' + product.find('a')['href'],
+                image_url=product.find('img', class_='sc-3c31b0ed-0')['src']
+            )
\ No newline at end of file
@@ -1,13 +1,13 @@
 from scrapers.base_scraper import BaseScraper, ScraperError
 from bs4 import BeautifulSoup
-from playwright.sync_api import sync_playwright
 import tools_api
 import logging
 
 class GarbarinoScraper(BaseScraper):
-    def __init__(self, query: str):
-        self.query = self.format_query(query)
-        self.products = []
+    store = 'Garbarino'
+
+    def __init__(self, query: str, max_results=None):
+        super().__init__(self.format_query(query), max_results=max_results)
 
     def format_query(self, query: str) -> str:
         return query.replace(" ", "%20")
@@ -19,6 +19,8 @@ class GarbarinoScraper(BaseScraper):
         :return: The HTML content of the Garbarino search results page.
         :rtype: str
         """
+        from playwright.sync_api import sync_playwright
+
         url = f'https://www.garbarino.com/{self.query}?_q={self.query}&map=ft'
 
         with sync_playwright() as p:
@@ -87,11 +89,5 @@ class GarbarinoScraper(BaseScraper):
                 else:
                     name = 'Unknown'
 
-            product_data = {
-                'name': name,
-                'price': price,
-                'url': url,
-                'image_url': image_url
-            }
 
-            self.products.append(product_data)
\ No newline at end of file
+            self.products.append(name=name, price=price, url=url, image_url=image_url)
\ No newline at end of file
@@ -3,22 +3,29 @@ from bs4 import BeautifulSoup
 import logging
 
 class PerozziScraper(BaseScraper):
-    def __init__(self, query: str):
-        self.query = self.format_query(query)
-        self.products = []
+    store = 'Perozzi'
+    results_per_page = 60
+
+    def __init__(self, query: str, max_results=None):
+        super().__init__(self.format_query(query), max_results=max_results)
 
     def format_query(self, query: str) -> str:
         return query.replace(" ", "%20")
 
+    def page_url(self, page):
+        return f'https://www.perozzi.com.ar/module/iqitsearch/searchiqit?order=product.position.desc&resultsPerPage={self.results_per_page}&page={page}&s={self.query}'
+
+    def is_last_page(self, html):
+        return html.count('js-product-miniature-wrapper') < self.results_per_page
+
     def fetch_results(self):
         """
-        Parse the HTML content of the Garbarino search results page and extract the product data.
+        Fetch the HTML content of the first Perozzi search results page.
 
-        :param html: The HTML content of the Garbarino search results page.
-        :type html: str
+        :return: The HTML content of the Perozzi search results page.
+        :rtype: str
         """
-        url = f'https://www.perozzi.com.ar/module/iqitsearch/searchiqit?order=product.position.desc&resultsPerPage=9999999&s={self.query}'
-        return self.get_html_from_url(url)
+        return self.fetch_page(1)
     
 
     def parse_results(self, html):
@@ -43,11 +50,5 @@ class PerozziScraper(BaseScraper):
             img_element = product.find('img', {'class': 'img-fluid'})
             image_url = img_element['data-src'] if 'data-src' in img_element.attrs else img_element['src']
 
-            product_data = {
-                'name': name,
-                'price': price,
-                'url': url,
-                'image_url': image_url
-            }
 
-            self.products.append(product_data)
\ No newline at end of file
+            self.products.append(name=name, price=price, url=url, image_url=image_url)
\ No newline at end of file
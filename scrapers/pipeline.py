@@ -0,0 +1,388 @@
+"""
+fetch -> parse -> save pipeline for many scrapers at once.
+
+- fetch: I/O bound, runs on a thread pool. Paginated stores fetch their
+  pages in parallel (see BaseScraper.fetch_pages).
+- parse: BeautifulSoup is pure Python and CPU bound, pages are parsed in a
+  process pool so parsing scales with cores instead of fighting for the GIL.
+  Workers receive one page and return a compact ProductBatch, the pages of a
+  scraper are merged back in order by a collector thread of the pipeline.
+- save: batches are handed to the write-behind writer (persistence.py), the
+  pipeline does not wait for the database.
+
+Stages are connected by bounded queues: when parsing or saving falls behind,
+the fetchers block instead of piling pages up in memory.
+
+run_profiled() runs the same stages one after the other under the profiler
+of profiling.py, for the opt-in profiling mode.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from records import ProductBatch
+from scrapers.base_scraper import ScraperError
+
+FETCH_WORKERS = 8
+PARSE_WORKERS = os.cpu_count() or 1
+QUEUE_SIZE = 16
+
+_DONE = object()
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    """
+    Create the shared parse process pool on first use.
+
+    :return: The process pool of this process.
+    :rtype: concurrent.futures.ProcessPoolExecutor
+    """
+    global _parse_pool
+    if _parse_pool is None:
+        with _parse_pool_lock:
+            if _parse_pool is None:
+                # fork keeps worker start cheap and does not re-import the entry
+                # point (app.py) in every worker, as spawn would.
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context('fork' if 'fork' in methods else None)
+                _parse_pool = ProcessPoolExecutor(max_workers=PARSE_WORKERS, mp_context=context)
+    return _parse_pool
+
+
+def discard_parse_pool(pool):
+    """
+    Drop a parse pool that cannot take work anymore (a worker died, e.g. killed
+    for memory, or it was shut down), the next get_parse_pool() call starts a new one.
+
+    :param pool: The pool that failed.
+    :type pool: concurrent.futures.ProcessPoolExecutor
+    """
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not pool:
+            return
+        _parse_pool = None
+    logging.error("Parse pool is unusable, starting a new one on next use")
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def parse_page(scraper_class, query, html):
+    """
+    Parse a results page, runs in a worker process.
+
+    :param scraper_class: Scraper class of the store, pickled by reference.
+    :type scraper_class: type
+    :param query: The search query.
+    :type query: str
+    :param html: The HTML content of the search results page.
+    :type html: str
+    :return: The products found on the page.
+    :rtype: records.ProductBatch
+    """
+    return scraper_class(query).parse(html)
+
+
+class _Job:
+    """
+    The pages of one scraper while they are being parsed, only touched by the
+    collector thread of the pipeline.
+    """
+    def __init__(self, scraper, pages):
+        self.scraper = scraper
+        self.batches = [None] * pages
+        self.remaining = pages
+        self.error = None
+
+    def merge(self):
+        """
+        Merge the page batches in order, dropping repeated URLs and stopping at max_results.
+        """
+        scraper = self.scraper
+        products = ProductBatch(scraper.store)
+        seen = set()
+        for batch in self.batches:
+            for product in batch or ():
+                if scraper.max_results and len(products) >= scraper.max_results:
+                    return products
+                url = product.url
+                if url not in seen:
+                    seen.add(url)
+                    products.append(product.name, product.price, url, product.image_url)
+        return products
+
+
+class Pipeline:
+    """
+    Run the fetch, parse and save stages of many scrapers concurrently.
+
+    :param send_notifications: If True, send email notifications on error and on price drops.
+    :type send_notifications: bool
+    :param save: If False, skip the save stage and only fill scraper.products.
+    :type save: bool
+    :param dedupe: If True, a product found by several scrapers of the same store
+                   (e.g. many queries) is saved only once per run.
+    :type dedupe: bool
+    :param on_done: Called as on_done(scraper, error) when a scraper finished,
+                    error is None on success. Runs on the pipeline threads.
+    :type on_done: callable, None
+    """
+    def __init__(self, send_notifications=False, save=True, dedupe=False, on_done=None, fetch_workers=FETCH_WORKERS, queue_size=QUEUE_SIZE):
+        self.send_notifications = send_notifications
+        self.save = save
+        self.dedupe = dedupe
+        self.on_done = on_done
+        self.fetch_workers = fetch_workers
+        self.queue_size = queue_size
+        self.errors = []
+        self._started = {}
+        self._seen = {}
+
+    def run(self, scrapers):
+        """
+        Run every scraper through the pipeline and wait until all of them are
+        parsed and queued for saving.
+
+        :param scrapers: Scrapers to run, their products are set in place.
+        :type scrapers: list
+        :return: The same scrapers.
+        :rtype: list
+        :raises Exception: The first unexpected error of any stage, after every scraper finished.
+        """
+        parse_queue = queue.Queue(self.queue_size)
+        # Unbounded, but never holds more than queue_size results (parse_slots).
+        results_queue = queue.Queue()
+        save_queue = queue.Queue(self.queue_size)
+        parse_slots = threading.BoundedSemaphore(self.queue_size)
+
+        writer = threading.Thread(target=self._write, args=(save_queue,), name='pipeline-writer', daemon=True)
+        collector = threading.Thread(target=self._collect, args=(results_queue, save_queue, parse_slots), name='pipeline-collect', daemon=True)
+        dispatcher = threading.Thread(target=self._dispatch, args=(parse_queue, results_queue, parse_slots), name='pipeline-parse', daemon=True)
+        writer.start()
+        collector.start()
+        dispatcher.start()
+
+        with ThreadPoolExecutor(max_workers=self.fetch_workers, thread_name_prefix='pipeline-fetch') as fetchers:
+            for scraper in scrapers:
+                fetchers.submit(self._fetch, scraper, parse_queue)
+        parse_queue.put(_DONE)
+        dispatcher.join()
+        collector.join()
+        writer.join()
+
+        if self.errors:
+            raise self.errors[0]
+        return scrapers
+
+    def _fetch(self, scraper, parse_queue):
+        self._started[id(scraper)] = time.time()
+        logging.info("Starting scraper: %s", scraper.__class__.__name__)
+        try:
+            pages = scraper.fetch_pages()
+        except Exception as e:
+            logging.error("Error fetching %s: %s", scraper.__class__.__name__, e)
+            self.errors.append(e)
+            self._done(scraper, e)
+            return
+        job = _Job(scraper, len(pages))
+        for index, html in enumerate(pages):
+            parse_queue.put((job, index, html))
+
+    def _dispatch(self, parse_queue, results_queue, parse_slots):
+        try:
+            while True:
+                item = parse_queue.get()
+                if item is _DONE:
+                    break
+                job, index, html = item
+                parse_slots.acquire()
+                pool = None
+                try:
+                    pool = get_parse_pool()
+                    future = pool.submit(parse_page, type(job.scraper), job.scraper.query, html)
+                except Exception as e:
+                    # A pool that cannot take work (broken or shut down) is replaced,
+                    # the page fails like a parse error would.
+                    if pool is not None:
+                        discard_parse_pool(pool)
+                    future = Future()
+                    future.set_exception(e)
+                    results_queue.put((job, index, future, None))
+                    continue
+                # The callback runs on the executor's manager thread, shared by every
+                # pipeline of the process: it only hands the result over, never blocks.
+                future.add_done_callback(lambda future, job=job, index=index, pool=pool: results_queue.put((job, index, future, pool)))
+            # Every slot is released only after its batch reached the save queue.
+            for _ in range(self.queue_size):
+                parse_slots.acquire()
+        finally:
+            results_queue.put(_DONE)
+
+    def _collect(self, results_queue, save_queue, parse_slots):
+        try:
+            while True:
+                item = results_queue.get()
+                if item is _DONE:
+                    break
+                try:
+                    self._parsed(*item, save_queue)
+                except Exception as e:
+                    logging.error("Error collecting parse result: %s", e)
+                    self.errors.append(e)
+                finally:
+                    parse_slots.release()
+        finally:
+            save_queue.put(_DONE)
+
+    def _parsed(self, job, index, future, pool, save_queue):
+        scraper = job.scraper
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool) and pool is not None:
+            discard_parse_pool(pool)
+        if error is None:
+            job.batches[index] = future.result()
+        elif isinstance(error, ScraperError) and index > 0:
+            # A broken page past the first one only loses that page,
+            # the result is then partial.
+            logging.warning("%s: skipping page %i: %s", scraper.__class__.__name__, index + 1, error)
+            scraper.truncated = True
+        elif job.error is None:
+            job.error = error
+        job.remaining -= 1
+        if job.remaining:
+            return
+
+        if job.error is None:
+            scraper.products = job.merge()
+            save_queue.put(scraper)
+        elif isinstance(job.error, ScraperError):
+            scraper.handle_error(job.error, send_notifications=self.send_notifications)
+            self._done(scraper, job.error)
+        else:
+            logging.error("Error parsing %s: %s", scraper.__class__.__name__, job.error)
+            self.errors.append(job.error)
+            self._done(scraper, job.error)
+
+    def _write(self, save_queue):
+        while True:
+            scraper = save_queue.get()
+            if scraper is _DONE:
+                break
+            try:
+                if self.save:
+                    products = self._unseen(scraper) if self.dedupe else scraper.products
+                    scraper.save(send_notifications=self.send_notifications, products=products)
+            except Exception as e:
+                logging.error("Error saving %s: %s", scraper.__class__.__name__, e)
+                self.errors.append(e)
+                self._done(scraper, e)
+                continue
+            elapsed_time = time.time() - self._started.pop(id(scraper), time.time())
+            logging.info("Scraper finished: %s, elapsed time: %.2f seconds", scraper.__class__.__name__, elapsed_time)
+            self._done(scraper, None)
+
+    def _unseen(self, scraper):
+        # Only called from the save stage thread, no locking needed.
+        seen = self._seen.setdefault(scraper.store, set())
+        products = ProductBatch(scraper.store)
+        for product in scraper.products:
+            url = product.url
+            if url not in seen:
+                seen.add(url)
+                products.append(product.name, product.price, url, product.image_url)
+        return products
+
+    def _done(self, scraper, error):
+        if self.on_done is None:
+            return
+        try:
+            self.on_done(scraper, error)
+        except Exception as e:
+            logging.error("Error in pipeline on_done callback: %s", e)
+
+
+def run_pipeline(scrapers, send_notifications=False, save=True, dedupe=False, on_done=None):
+    """
+    Run many scrapers through the fetch -> parse -> save pipeline.
+
+    :param scrapers: Scrapers to run, their products are set in place.
+    :type scrapers: list
+    :param send_notifications: If True, send email notifications on error and on price drops.
+    :type send_notifications: bool
+    :param save: If False, skip the save stage.
+    :type save: bool
+    :param dedupe: If True, save a product found by several scrapers of the same store only once.
+    :type dedupe: bool
+    :param on_done: Called as on_done(scraper, error) when each scraper finished.
+    :type on_done: callable, None
+    :return: The same scrapers.
+    :rtype: list
+    """
+    return Pipeline(send_notifications=send_notifications, save=save, dedupe=dedupe, on_done=on_done).run(scrapers)
+
+
+def run_profiled(scrapers, profiler, send_notifications=False, save=True):
+    """
+    Run scrapers one stage at a time in the calling thread, each stage of each
+    store under profiler.stage() (see profiling.py). Same results as run_pipeline,
+    without the overlap: parsing stays in this process and the products are
+    saved synchronously, so the profiles show the real parse and save work.
+
+    :param scrapers: Scrapers to run, their products are set in place.
+    :type scrapers: list
+    :param profiler: Profiler of the run.
+    :type profiler: profiling.RunProfiler
+    :param send_notifications: If True, send email notifications on error and on price drops.
+    :type send_notifications: bool
+    :param save: If False, skip the save stage.
+    :type save: bool
+    :return: The same scrapers.
+    :rtype: list
+    :raises Exception: The first unexpected error, after every scraper finished.
+    """
+    from persistence import save_products
+
+    errors = []
+    for scraper in scrapers:
+        name = scraper.__class__.__name__
+        started = time.time()
+        logging.info("Starting scraper (profiled): %s", name)
+        try:
+            with profiler.stage('fetch', scraper.store):
+                pages = scraper.fetch_pages()
+
+            job = _Job(scraper, len(pages))
+            with profiler.stage('parse', scraper.store):
+                for index, html in enumerate(pages):
+                    try:
+                        job.batches[index] = scraper.parse(html)
+                    except ScraperError as e:
+                        if index == 0:
+                            raise
+                        logging.warning("%s: skipping page %i: %s", name, index + 1, e)
+                        scraper.truncated = True
+                scraper.products = job.merge()
+
+            if save:
+                with profiler.stage('save', scraper.store):
+                    save_products(scraper.store, scraper.query, scraper.products, complete=scraper.complete)
+                    if send_notifications:
+                        scraper.notify_price_drops()
+        except ScraperError as e:
+            scraper.handle_error(e, send_notifications=send_notifications)
+            continue
+        except Exception as e:
+            logging.error("Error running %s: %s", name, e)
+            errors.append(e)
+            continue
+        logging.info("Scraper finished: %s, elapsed time: %.2f seconds", name, time.time() - started)
+
+    if errors:
+        raise errors[0]
+    return scrapers
@@ -0,0 +1,75 @@
+"""
+Registry of the available stores.
+Stores are declared by name with the dotted path of their scraper class; the
+module (and heavy dependencies like Playwright) is only imported the first time
+that store is used.
+"""
+import importlib
+import threading
+
+SCRAPERS = {
+    'Fravega': 'scrapers.fravega_scraper.FravegaScraper',
+    'Garbarino': 'scrapers.gabarino_scraper.GarbarinoScraper',
+    'Perozzi': 'scrapers.perozzi_scraper.PerozziScraper',
+}
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+def register(store, path):
+    """
+    Declare a store without importing it.
+
+    :param store: Store name, e.g. 'Fravega'.
+    :type store: str
+    :param path: Dotted path of the scraper class.
+    :type path: str
+    """
+    SCRAPERS[store] = path
+    _loaded.pop(store, None)
+
+
+def available_stores():
+    """
+    :return: Names of the registered stores.
+    :rtype: list
+    """
+    return list(SCRAPERS)
+
+
+def get_scraper_class(store):
+    """
+    Import the scraper class of a store on first use.
+
+    :param store: Store name, e.g. 'Fravega'.
+    :type store: str
+    :return: The scraper class.
+    :rtype: type
+    :raises KeyError: If the store is not registered.
+    """
+    scraper_class = _loaded.get(store)
+    if scraper_class is None:
+        with _lock:
+            scraper_class = _loaded.get(store)
+            if scraper_class is None:
+                module_name, class_name = SCRAPERS[store].rsplit('.', 1)
+                scraper_class = getattr(importlib.import_module(module_name), class_name)
+                _loaded[store] = scraper_class
+    return scraper_class
+
+
+def create_scraper(store, query, max_results=None):
+    """
+    Create the scraper of a store for a query.
+
+    :param store: Store name, e.g. 'Fravega'.
+    :type store: str
+    :param query: The search query.
+    :type query: str
+    :param max_results: Stop fetching pages once this many products are found.
+    :type max_results: int, None
+    :return: A scraper instance ready to run.
+    :rtype: BaseScraper
+    """
+    return get_scraper_class(store)(query, max_results=max_results)